@@ -1,12 +1,29 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import os, shutil
+import os, json, time, asyncio, threading
 
 from app.lesson_service import create_lesson
-from app.session_manager import start_session, next_step, ask_question
+from app.course_ingest import open_course_ingestion, get_ingest_job
+from app.session_manager import (
+    start_session,
+    next_step,
+    next_step_speech,
+    iter_next_step_sentences,
+    ask_question,
+    ask_question_stream,
+)
 from app.lesson_plan import load_lesson_plan
-from app.config import BASE_LESSON_DIR
+from app.config import ASK_DEADLINE_SECONDS, BASE_LESSON_DIR
+from app.llm_scheduler import LLMCancelled, LLMDeadlineExceeded, LLMOverloaded
+from app.ollama_client import llm_scheduler_stats
+from app.singleflight import singleflight_stats
+from app.context_pack import context_stats
+from app.dialogue_memory import dialogue_stats
+from app.embedders import EmbeddingMismatchError
+from app.uploads import UploadError, multipart_boundary, remove_uploads, stream_pdf_uploads
 
 
 app = FastAPI(title="AI Tutor Microservice")
@@ -50,29 +67,122 @@ def health():
 
 
 # -------------------------------------------------
-# Upload PDF → Generate Lesson
+# LLM Scheduler Metrics (queue wait per priority class)
 # -------------------------------------------------
-@app.post("/lesson/upload")
-async def upload_lesson(title: str, file: UploadFile = File(...)):
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Only PDF files are allowed")
+@app.get("/metrics/llm")
+def llm_metrics():
+    return llm_scheduler_stats()
+
+
+@app.get("/metrics/singleflight")
+def singleflight_metrics():
+    return singleflight_stats()
+
 
-    os.makedirs(BASE_LESSON_DIR, exist_ok=True)
+@app.get("/metrics/context")
+def context_metrics():
+    return context_stats()
 
-    pdf_path = os.path.join(BASE_LESSON_DIR, f"{title}.pdf")
 
-    with open(pdf_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+@app.get("/metrics/dialogue")
+def dialogue_metrics():
+    return dialogue_stats()
 
-    result = create_lesson(pdf_path, title)
+
+# -------------------------------------------------
+# Upload PDF → Generate Lesson
+# -------------------------------------------------
+def _pdf_upload_body(field: str, many: bool):
+    """OpenAPI body for endpoints that parse multipart themselves (keeps /docs usable)."""
+    file_schema = {"type": "string", "format": "binary"}
+    schema = {"type": "array", "items": file_schema} if many else file_schema
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {
+                    "schema": {"type": "object", "properties": {field: schema}, "required": [field]}
+                }
+            },
+        }
+    }
+
+
+@app.post("/lesson/upload", openapi_extra=_pdf_upload_body("file", many=False))
+async def upload_lesson(title: str, request: Request):
+    """
+    multipart/form-data with one PDF file part. The file is streamed to
+    lessons/<slugify(title)>.pdf while it arrives (size-limited, hashed).
+    """
+    try:
+        saved = await stream_pdf_uploads(request, BASE_LESSON_DIR, lambda _: title, max_files=1)
+    except UploadError as e:
+        # e.g. a second file part: don't leave the first one behind
+        remove_uploads(e.saved)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    upload = saved[0]
+
+    # extraction + embedding + planning are blocking; keep them off the event loop
+    try:
+        result = await run_in_threadpool(create_lesson, upload.path, title)
+    except Exception:
+        remove_uploads(saved)
+        raise
 
     return {
         "status": "lesson_created",
         "lesson_id": result["lesson_id"],
-        "title": result["title"]
+        "title": result["title"],
+        "sha256": upload.sha256,
+        "size": upload.size,
+    }
+
+
+# -------------------------------------------------
+# Upload many PDFs → Generate a Lesson per PDF (pipelined)
+# -------------------------------------------------
+@app.post("/course/upload", openapi_extra=_pdf_upload_body("files", many=True))
+async def upload_course(request: Request):
+    """
+    multipart/form-data with one PDF file part per lesson (titled by file
+    name). Each PDF enters the ingestion pipeline as soon as it has been
+    received, while the rest of the upload is still streaming.
+    """
+    try:
+        # don't start a pipeline for a request that can't carry any files
+        multipart_boundary(request)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    job = open_course_ingestion()
+    try:
+        saved = await stream_pdf_uploads(
+            request,
+            BASE_LESSON_DIR,
+            lambda filename: os.path.splitext(filename)[0],
+            on_file=lambda upload: job.add_file(upload.path, upload.title),
+        )
+    except UploadError as e:
+        # files completed before the error keep going through the pipeline
+        raise HTTPException(status_code=e.status_code, detail=f"{e.detail} (job {job.job_id})")
+    finally:
+        job.close()
+
+    return {
+        "status": "ingestion_started",
+        **job.to_dict(),
+        "uploads": [upload.to_dict() for upload in saved],
     }
 
 
+@app.get("/course/jobs/{job_id}")
+def course_job_status(job_id: str):
+    job = get_ingest_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return job.to_dict()
+
+
 # -------------------------------------------------
 # Get List of Lessons
 # -------------------------------------------------
@@ -107,7 +217,10 @@ def get_lesson(lesson_id: str):
 # -------------------------------------------------
 @app.post("/session/start")
 def route_start(req: StartSession):
-    return start_session(req.user_id, req.lesson_id)
+    try:
+        return start_session(req.user_id, req.lesson_id)
+    except EmbeddingMismatchError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 @app.post("/session/next")
@@ -115,6 +228,82 @@ def route_next(req: StepRequest):
     return next_step(req.session_id)
 
 
+@app.post("/session/next/speech")
+def route_next_speech(req: StepRequest):
+    """Next step as plain text plus precomputed SSML."""
+    return next_step_speech(req.session_id)
+
+
+@app.post("/session/next/speech/stream")
+def route_next_speech_stream(req: StepRequest):
+    """Next step as NDJSON, one {text, ssml} sentence per line."""
+    lines = (json.dumps(s, ensure_ascii=False) + "\n" for s in iter_next_step_sentences(req.session_id))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+# -------------------------------------------------
+# Student Questions (admission control, deadline, cancel on disconnect)
+# -------------------------------------------------
+def _llm_http_error(e: Exception) -> HTTPException:
+    if isinstance(e, LLMOverloaded):
+        return HTTPException(
+            status_code=503,
+            detail="Tutor is busy, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    if isinstance(e, LLMDeadlineExceeded):
+        return HTTPException(status_code=504, detail="The answer took too long")
+    # LLMCancelled: the client is gone, nobody reads this
+    return HTTPException(status_code=499, detail="Client closed request")
+
+
+async def _cancel_on_disconnect(request: Request, cancel: threading.Event) -> None:
+    while not cancel.is_set():
+        if await request.is_disconnected():
+            cancel.set()
+            return
+        await asyncio.sleep(0.25)
+
+
 @app.post("/session/ask")
-def route_ask(req: AskRequest):
-    return ask_question(req.session_id, req.question)
+async def route_ask(req: AskRequest, request: Request):
+    deadline = time.monotonic() + ASK_DEADLINE_SECONDS
+    cancel = threading.Event()
+    watcher = asyncio.create_task(_cancel_on_disconnect(request, cancel))
+    try:
+        return await run_in_threadpool(ask_question, req.session_id, req.question, deadline, cancel)
+    except (LLMOverloaded, LLMDeadlineExceeded, LLMCancelled) as e:
+        raise _llm_http_error(e)
+    finally:
+        cancel.set()
+        watcher.cancel()
+
+
+@app.post("/session/ask/stream")
+async def route_ask_stream(req: AskRequest, request: Request):
+    deadline = time.monotonic() + ASK_DEADLINE_SECONDS
+    cancel = threading.Event()
+    chunks = await run_in_threadpool(ask_question_stream, req.session_id, req.question, deadline, cancel)
+
+    # wait for the first chunk before sending headers, so shedding and
+    # deadlines can still become a 503 / 504
+    watcher = asyncio.create_task(_cancel_on_disconnect(request, cancel))
+    try:
+        first = await run_in_threadpool(next, chunks, None)
+    except (LLMOverloaded, LLMDeadlineExceeded, LLMCancelled) as e:
+        cancel.set()
+        raise _llm_http_error(e)
+    finally:
+        watcher.cancel()
+
+    async def body():
+        try:
+            chunk = first
+            while chunk is not None:
+                yield chunk
+                chunk = await run_in_threadpool(next, chunks, None)
+        finally:
+            # client disconnected (or done): leave the shared generation
+            cancel.set()
+
+    return StreamingResponse(body(), media_type="text/plain")
@@ -0,0 +1,168 @@
+# app/chunker.py
+
+"""
+Token-aware, span-based chunking.
+
+Chunks are produced as (start, end) character spans into the source text,
+so nothing is copied until a caller slices the text. Sizes are measured in
+embedder tokens (not characters), so a chunk never exceeds the embedder's
+window and gets silently truncated. Paragraphs are packed greedily; a
+paragraph longer than the budget is split on token boundaries, and each new
+chunk starts with the last `overlap_tokens` tokens of the previous one.
+"""
+
+import re
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+Span = Tuple[int, int]
+# maps a batch of strings to per-string token (start, end) offsets
+OffsetsFn = Callable[[List[str]], List[Sequence[Span]]]
+
+_PARA_SEP_RE = re.compile(r"\n\s*\n")
+_REGEX_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# paragraphs handed to the tokenizer per call (fast tokenizers batch well)
+_TOKENIZE_BATCH = 64
+
+
+def regex_token_offsets(texts: List[str]) -> List[List[Span]]:
+    """Tokenizer-free approximation: one token per word or punctuation mark."""
+    return [[m.span() for m in _REGEX_TOKEN_RE.finditer(t)] for t in texts]
+
+
+def hf_token_offsets(tokenizer) -> OffsetsFn:
+    """Offsets function backed by a HuggingFace fast tokenizer."""
+
+    def offsets(texts: List[str]) -> List[Sequence[Span]]:
+        enc = tokenizer(
+            texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return enc["offset_mapping"]
+
+    return offsets
+
+
+def _iter_paragraph_spans(text: str) -> Iterator[Span]:
+    pos = 0
+    for sep in _PARA_SEP_RE.finditer(text):
+        yield from _strip_span(text, pos, sep.start())
+        pos = sep.end()
+    yield from _strip_span(text, pos, len(text))
+
+
+def _strip_span(text: str, start: int, end: int) -> Iterator[Span]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start < end:
+        yield start, end
+
+
+def _iter_paragraph_tokens(
+    text: str, offsets_fn: OffsetsFn
+) -> Iterator[Tuple[int, Sequence[Span]]]:
+    """(paragraph start, relative token offsets) pairs, tokenized in batches."""
+    batch: List[Span] = []
+
+    def flush() -> Iterator[Tuple[int, Sequence[Span]]]:
+        pieces = [text[s:e] for s, e in batch]
+        for (p_start, _), offs in zip(batch, offsets_fn(pieces)):
+            if offs:
+                yield p_start, offs
+
+    for span in _iter_paragraph_spans(text):
+        batch.append(span)
+        if len(batch) >= _TOKENIZE_BATCH:
+            yield from flush()
+            batch = []
+    if batch:
+        yield from flush()
+
+
+class _Window:
+    """
+    Tokens of the chunk being built, kept as slices of per-paragraph offset
+    lists ([base, offsets, lo, hi]) rather than one flat token list.
+    """
+
+    def __init__(self):
+        self.parts: List[list] = []
+        self.count = 0
+
+    def add(self, base: int, offs: Sequence[Span]) -> None:
+        self.parts.append([base, offs, 0, len(offs)])
+        self.count += len(offs)
+
+    def span(self, n_tokens: Optional[int] = None) -> Span:
+        """Span of the first n_tokens (default: all) tokens."""
+        first = self.parts[0]
+        start = first[0] + first[1][first[2]][0]
+        remaining = self.count if n_tokens is None else n_tokens
+        for base, offs, lo, hi in self.parts:
+            if remaining <= hi - lo:
+                return start, base + offs[lo + remaining - 1][1]
+            remaining -= hi - lo
+        base, offs, _, hi = self.parts[-1]
+        return start, base + offs[hi - 1][1]
+
+    def drop(self, n_tokens: int) -> None:
+        """Remove the first n_tokens tokens."""
+        self.count = max(self.count - n_tokens, 0)
+        while n_tokens and self.parts:
+            part = self.parts[0]
+            size = part[3] - part[2]
+            if n_tokens < size:
+                part[2] += n_tokens
+                return
+            n_tokens -= size
+            self.parts.pop(0)
+
+    def keep_last(self, n_tokens: int) -> None:
+        self.drop(max(self.count - n_tokens, 0))
+
+
+def iter_chunk_spans(
+    text: str,
+    max_tokens: int = 200,
+    overlap_tokens: int = 50,
+    offsets_fn: Optional[OffsetsFn] = None,
+) -> Iterator[Span]:
+    """
+    Lazily yield (start, end) spans of chunks of at most `max_tokens` tokens.
+    """
+    offsets_fn = offsets_fn or regex_token_offsets
+    max_tokens = max(max_tokens, 1)
+    overlap = max(0, min(overlap_tokens, max_tokens // 2))
+
+    window = _Window()
+    for base, offs in _iter_paragraph_tokens(text, offsets_fn):
+        if window.count and window.count + len(offs) > max_tokens:
+            yield window.span()
+            # carry the overlap only if the paragraph still fits after it
+            if overlap and overlap + len(offs) <= max_tokens:
+                window.keep_last(overlap)
+            else:
+                window.keep_last(0)
+        window.add(base, offs)
+
+        # oversized paragraph: hard split on token boundaries
+        while window.count > max_tokens:
+            yield window.span(max_tokens)
+            window.drop(max_tokens - overlap)
+
+    if window.count:
+        yield window.span()
+
+
+def chunk_spans(
+    text: str,
+    max_tokens: int = 200,
+    overlap_tokens: int = 50,
+    offsets_fn: Optional[OffsetsFn] = None,
+) -> List[Span]:
+    return list(iter_chunk_spans(text, max_tokens, overlap_tokens, offsets_fn))
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 # Use internal Docker hostname so FastAPI can reach Ollama container
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/chat")
@@ -10,3 +11,81 @@ REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "120"))
 
 BASE_LESSON_DIR = os.path.join(os.path.dirname(__file__), "lessons")
 os.makedirs(BASE_LESSON_DIR, exist_ok=True)
+
+# Largest accepted PDF upload (per file)
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_MB", "100")) * 2**20
+
+# Prompt budget (chars) shared by the Ollama client and the lesson planner
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "9000"))
+
+# Plan several subtopics of a topic per schema-constrained call; each gets an
+# excerpt of MAX_PROMPT_CHARS / batch size, but never less than the minimum
+PLANNING_BATCH = os.getenv("PLANNING_BATCH", "1") == "1"
+PLANNING_MIN_SUBTOPIC_CHARS = int(os.getenv("PLANNING_MIN_SUBTOPIC_CHARS", "1800"))
+
+# Hybrid retrieval: fuse BM25 and dense rankings with reciprocal-rank fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Chunk size / overlap in embedder tokens (capped to the embedder window)
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "200"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+
+# Sentence embedder
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "all-MiniLM-L6-v2")
+# Embedder backend: "torch", "onnx" or "onnx-int8" (see app/embedders.py)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+EMBED_ONNX_INT8_FILE = os.getenv("EMBED_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+# Intra-op threads for the embedder (0 = library default) and encode batch size
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+
+# Optional shared embedding service (one model process for all API workers)
+EMBED_SERVICE = os.getenv("EMBED_SERVICE", "0") == "1"
+# POSIX default: a socket inside a per-user 0700 directory, not world-visible /tmp
+EMBED_SERVICE_ADDRESS = os.getenv(
+    "EMBED_SERVICE_ADDRESS",
+    r"\\.\pipe\vitall-embed"
+    if os.name == "nt"
+    else os.path.join(tempfile.gettempdir(), f"vitall-{os.getuid()}", "embed.sock"),
+)
+# Shared secret between the service and API workers; no default on purpose
+# (run.py generates one per launch when it is unset)
+EMBED_SERVICE_AUTHKEY = os.getenv("EMBED_SERVICE_AUTHKEY", "").encode()
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "256"))
+EMBED_BATCH_WAIT_MS = int(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+# Concurrent generations sent to Ollama
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "2"))
+
+# Bulk course ingestion
+INGEST_EXTRACT_WORKERS = int(os.getenv("INGEST_EXTRACT_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "512"))
+INGEST_PLAN_WORKERS = int(os.getenv("INGEST_PLAN_WORKERS", str(2 * OLLAMA_CONCURRENCY)))
+# finished jobs stay queryable this long, and at most this many are kept
+INGEST_JOB_TTL_SECONDS = int(os.getenv("INGEST_JOB_TTL_SECONDS", "3600"))
+INGEST_MAX_JOBS = int(os.getenv("INGEST_MAX_JOBS", "100"))
+
+# LLM scheduler: max slots background planning may hold (default: all) and
+# whether a waiting interactive call may preempt a running background one
+LLM_BACKGROUND_SLOTS = int(os.getenv("LLM_BACKGROUND_SLOTS", "0")) or None
+LLM_PREEMPT_BACKGROUND = os.getenv("LLM_PREEMPT_BACKGROUND", "1") == "1"
+
+# Admission control: interactive/step calls allowed to wait for a slot before
+# new ones are shed with 503 + Retry-After (0 = unbounded), and the deadline
+# of a student question (queueing + generation)
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16")) or None
+ASK_DEADLINE_SECONDS = float(os.getenv("ASK_DEADLINE_SECONDS", "60"))
+
+# Context budgets (chars) filled by app.context_pack
+PLANNING_CONTEXT_CHARS = int(os.getenv("PLANNING_CONTEXT_CHARS", "5000"))
+ASK_CONTEXT_CHARS = int(os.getenv("ASK_CONTEXT_CHARS", "3200"))
+
+# Questions search the current subtopic's (then topic's) chunks first and only
+# fall back to the whole lesson when the best cosine score is below this
+ASK_SCOPE_MIN_SCORE = float(os.getenv("ASK_SCOPE_MIN_SCORE", "0.35"))
+
+# Per-session dialogue memory (tokens): total budget for earlier turns in a
+# question prompt, of which the rolling summary may use at most the second
+DIALOGUE_MEMORY_TOKENS = int(os.getenv("DIALOGUE_MEMORY_TOKENS", "600"))
+DIALOGUE_SUMMARY_TOKENS = int(os.getenv("DIALOGUE_SUMMARY_TOKENS", "200"))
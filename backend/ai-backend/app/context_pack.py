@@ -0,0 +1,195 @@
+# app/context_pack.py
+
+"""
+Context assembly for prompts.
+
+Retrieved chunks overlap (they are built with a token overlap) and often
+cover the same passage, so concatenating the top-k sends duplicate text to
+Ollama and inflates prefill time. pack_context() does one search pass and:
+
+1. selects candidates MMR-style (relevance from the search score -- fused
+   RRF when hybrid -- min-max normalized over the pool, minus vector
+   similarity to what is already selected), dropping near-duplicates
+   outright;
+2. stops at the first pick that no longer fits the character budget;
+3. merges adjacent / overlapping chunks back into contiguous passages using
+   their source spans, in document order.
+
+Each call also reports how much text the previous packing would have sent
+for the same query: the top `naive_k` ranked chunks joined whole.
+"""
+
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.lexical import BM25Index
+from app.rag import encode_query, search_scored
+
+Span = Tuple[int, int]
+
+# chars per token, for reporting only (MiniLM / phi3 average on English prose)
+_CHARS_PER_TOKEN = 4
+
+_totals_lock = threading.Lock()
+_totals = {"requests": 0, "naive_chars": 0, "packed_chars": 0, "duplicates_dropped": 0}
+
+
+def _chunk_vectors(index, ids: Sequence[int]) -> Optional[np.ndarray]:
+    """Stored (normalized) vectors of the given chunks, if the index can reconstruct."""
+    try:
+        return np.vstack([index.reconstruct(int(i)) for i in ids]).astype(np.float32)
+    except Exception:
+        return None
+
+
+def _merge(selected: List[int], chunks: List[str], spans: Optional[List[Span]]) -> List[str]:
+    """Selected chunks as passages; overlapping/adjacent spans become one passage."""
+    if not spans:
+        return [chunks[i] for i in selected]
+
+    passages: List[str] = []
+    cur_text, cur_end = "", -1
+    for i in sorted(selected, key=lambda i: spans[i][0]):
+        start, end = spans[i]
+        text = chunks[i]
+        if cur_text and start <= cur_end + 2:
+            # chunk texts are exact source slices, so the overlap is an offset
+            if end > cur_end:
+                cur_text += text[max(cur_end - start, 0):] if start <= cur_end else "\n\n" + text
+                cur_end = end
+            continue
+        if cur_text:
+            passages.append(cur_text)
+        cur_text, cur_end = text, end
+    if cur_text:
+        passages.append(cur_text)
+    return passages
+
+
+def _naive_count(lengths: List[int], naive_k: int, naive_min_chars: int) -> int:
+    """How many top-ranked chunks the previous packing would have sent whole."""
+    if sum(n + 2 for n in lengths[:naive_k]) < naive_min_chars:
+        return min(2 * naive_k, len(lengths))
+    return min(naive_k, len(lengths))
+
+
+def pack_context(
+    index,
+    chunks: List[str],
+    query: str,
+    budget_chars: int,
+    lexical: Optional[BM25Index] = None,
+    spans: Optional[List[Span]] = None,
+    depth: int = 24,
+    diversity: float = 0.1,
+    dup_threshold: float = 0.92,
+    scope: Optional[Sequence[int]] = None,
+    q_vec: Optional[np.ndarray] = None,
+    naive_k: int = 4,
+    naive_min_chars: int = 0,
+) -> Tuple[List[str], Dict[str, Any]]:
+    """
+    Returns (passages, stats). `diversity` is the MMR trade-off (0 = pure
+    relevance); candidates with cosine >= dup_threshold to an already
+    selected chunk are dropped as near-duplicates. `scope` restricts the
+    search to those chunk ids; stats["chunk_ids"] lists the chunks used.
+
+    naive_k / naive_min_chars describe the packing this replaces, for the
+    token-savings stats only: the top naive_k chunks joined whole (twice as
+    many when those come to less than naive_min_chars).
+    """
+    if not chunks:
+        return [], {"chunk_ids": [], "naive_tokens": 0, "packed_tokens": 0, "tokens_saved": 0}
+
+    if q_vec is None:
+        q_vec = encode_query(query)
+    ranked, scores = search_scored(index, chunks, query, depth, lexical, q_vec=q_vec, scope=scope)
+    if spans is not None and len(spans) != len(chunks):
+        spans = None
+    lengths = [len(chunks[i]) for i in ranked]
+    naive_n = _naive_count(lengths, naive_k, naive_min_chars)
+
+    # relevance is the search score itself (fused RRF when hybrid, so exact-term
+    # BM25 hits with a low cosine keep their place), stretched to [0, 1] over
+    # the pool: the best candidate scores 1, the weakest 0
+    scores = np.asarray(scores, dtype=np.float32)
+    spread = float(scores.max() - scores.min()) if len(scores) else 0.0
+    if spread > 0:
+        relevance = (scores - scores.min()) / spread
+    else:
+        relevance = np.ones(len(ranked), dtype=np.float32)
+
+    # stored vectors only drive the redundancy / near-duplicate terms
+    vectors = _chunk_vectors(index, ranked)
+    if vectors is not None:
+        similarity = vectors @ vectors.T
+    else:
+        similarity = np.eye(len(ranked), dtype=np.float32)
+
+    remaining = list(range(len(ranked)))
+    chosen: List[int] = []  # positions in `ranked`
+    used = 0
+    duplicates = 0
+
+    while remaining:
+        if chosen:
+            max_sim = similarity[np.ix_(remaining, chosen)].max(axis=1)
+        else:
+            max_sim = np.zeros(len(remaining), dtype=np.float32)
+        mmr = (1.0 - diversity) * relevance[remaining] - diversity * max_sim
+        best = int(np.argmax(mmr))
+        pos = remaining.pop(best)
+
+        if chosen and max_sim[best] >= dup_threshold:
+            if pos < naive_n:
+                # only duplicates the previous packing would actually have sent
+                duplicates += 1
+            continue
+
+        cost = len(chunks[ranked[pos]])
+        if spans is not None:
+            # only the part not already covered by a selected chunk costs budget
+            merged = _merge([ranked[p] for p in chosen + [pos]], chunks, spans)
+            cost = sum(map(len, merged)) - used
+        if used + cost > budget_chars and chosen:
+            # budget is full: anything further down is less relevant, and
+            # topping up the remainder from there only pulls in tail chunks
+            break
+        chosen.append(pos)
+        used += cost
+        if used >= budget_chars:
+            break
+
+    passages = _merge([ranked[p] for p in chosen], chunks, spans)
+
+    naive_chars = sum(n + 2 for n in lengths[:naive_n])
+    packed_chars = sum(len(p) + 2 for p in passages)
+    with _totals_lock:
+        _totals["requests"] += 1
+        _totals["naive_chars"] += naive_chars
+        _totals["packed_chars"] += packed_chars
+        _totals["duplicates_dropped"] += duplicates
+
+    stats = {
+        "chunk_ids": sorted(ranked[p] for p in chosen),
+        "chunks": len(chosen),
+        "passages": len(passages),
+        "duplicates_dropped": duplicates,
+        "naive_tokens": naive_chars // _CHARS_PER_TOKEN,
+        "packed_tokens": packed_chars // _CHARS_PER_TOKEN,
+        "tokens_saved": max(naive_chars - packed_chars, 0) // _CHARS_PER_TOKEN,
+    }
+    return passages, stats
+
+
+def context_stats() -> Dict[str, Any]:
+    with _totals_lock:
+        totals = dict(_totals)
+    saved = max(totals["naive_chars"] - totals["packed_chars"], 0)
+    totals["tokens_saved"] = saved // _CHARS_PER_TOKEN
+    totals["tokens_saved_per_request"] = (
+        round(totals["tokens_saved"] / totals["requests"], 1) if totals["requests"] else 0.0
+    )
+    return totals
@@ -0,0 +1,309 @@
+# app/course_ingest.py
+
+"""
+Bulk course ingestion: many PDFs through one pipeline instead of one
+create_lesson() after another.
+
+    extract (process pool) -> embed (one thread, batched across documents)
+        -> plan (bounded queue drained by INGEST_PLAN_WORKERS threads)
+
+Extraction and embedding are cheap next to LLM planning, so the pipeline
+keeps the planner queue fed and total time approaches the LLM-bound floor
+(sum of per-file LLM time / OLLAMA_CONCURRENCY) rather than the sum of
+per-file times. Each file reports its own stage and timings.
+
+Files may be added while the job runs (add_file / close), so a streamed
+course upload starts extracting its first PDFs before the last ones have
+arrived.
+"""
+
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+from app.config import (
+    INGEST_EMBED_BATCH,
+    INGEST_EXTRACT_WORKERS,
+    INGEST_JOB_TTL_SECONDS,
+    INGEST_MAX_JOBS,
+    INGEST_PLAN_WORKERS,
+    OLLAMA_CONCURRENCY,
+)
+from app.lesson_plan import (
+    generate_lesson_plan_from_text,
+    last_call_stats,
+    save_lesson_plan,
+    slugify,
+    unique_title,
+)
+from app.rag import build_flat_index, chunk_text_spans, get_embedder, save_rag_index
+from app.utils.pdf_reader import extract_text_from_pdf
+
+_jobs: Dict[str, "IngestJob"] = {}
+
+_DONE = object()
+
+
+class _FileItem:
+    def __init__(self, pdf_path: str, title: str):
+        self.pdf_path = pdf_path
+        self.title = title
+        self.lesson_id = slugify(title)
+        self.stage = "queued"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.llm: Dict[str, float] = {}
+        self.text = ""
+        self._stage_started = time.time()
+
+    def enter(self, stage: str) -> None:
+        now = time.time()
+        if self.stage not in ("queued", "done", "error"):
+            self.timings[self.stage] = round(now - self._stage_started, 2)
+        self.stage = stage
+        self._stage_started = now
+
+    def fail(self, error: Exception) -> None:
+        self.error = str(error)
+        self.enter("error")
+        self.text = ""
+        print(f"[WARN] Ingestion failed for '{self.title}': {error}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "title": self.title,
+            "lesson_id": self.lesson_id,
+            "stage": self.stage,
+            "error": self.error,
+            "timings": self.timings,
+            **self.llm,
+        }
+
+
+class IngestJob:
+    def __init__(self, files: Optional[List[_FileItem]] = None):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.files: List[_FileItem] = []
+        self._lesson_ids: Set[str] = set()
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.receiving = True
+        self._incoming: "queue.Queue[Any]" = queue.Queue()
+        # extractions whose result has not been handed on yet
+        self._extracting = 0
+        self._extract_cond = threading.Condition()
+        self._embed_q: "queue.Queue[Any]" = queue.Queue()
+        # bounded: embedding may run ahead of planning only this far
+        self._plan_q: "queue.Queue[Any]" = queue.Queue(maxsize=2 * INGEST_PLAN_WORKERS)
+        for item in files or []:
+            self._add(item)
+
+    # ---------- input ----------
+
+    def _add(self, item: _FileItem) -> None:
+        if item.lesson_id in self._lesson_ids:
+            # two files with the same slug would overwrite each other's lesson
+            item.title = unique_title(item.title, self._lesson_ids)
+            item.lesson_id = slugify(item.title)
+        self._lesson_ids.add(item.lesson_id)
+        self.files.append(item)
+        self._incoming.put(item)
+
+    def add_file(self, pdf_path: str, title: str) -> None:
+        """
+        Queue one more PDF; extraction starts as soon as a worker is free.
+        A title whose slug is already taken in this job gets a " 2" suffix.
+        """
+        self._add(_FileItem(pdf_path, title))
+
+    def close(self) -> None:
+        """No more files will be added."""
+        if self.receiving:
+            self.receiving = False
+            self._incoming.put(_DONE)
+
+    # ---------- stages ----------
+
+    def _extracted(self, item: _FileItem, fut) -> None:
+        try:
+            item.text = fut.result()
+            item.enter("embedding")
+            self._embed_q.put(item)
+        except Exception as e:
+            item.fail(e)
+        finally:
+            with self._extract_cond:
+                self._extracting -= 1
+                self._extract_cond.notify_all()
+
+    def _extract_stage(self) -> None:
+        # spawn, not fork: the parent holds model weights, FAISS indexes and
+        # running threads that a forked worker would inherit
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=INGEST_EXTRACT_WORKERS, mp_context=spawn) as pool:
+            while True:
+                item = self._incoming.get()
+                if item is _DONE:
+                    break
+                item.enter("extracting")
+                with self._extract_cond:
+                    self._extracting += 1
+                fut = pool.submit(extract_text_from_pdf, item.pdf_path)
+                # hands each file on as soon as it is extracted
+                fut.add_done_callback(lambda f, item=item: self._extracted(item, f))
+            # done-callbacks run after the future resolves; wait for them, not the futures
+            with self._extract_cond:
+                self._extract_cond.wait_for(lambda: self._extracting == 0)
+        self._embed_q.put(_DONE)
+
+    def _embed_stage(self) -> None:
+        embedder = get_embedder()
+        pending: List[Any] = []  # (item, spans, chunks)
+        n_pending = 0
+        finished = False
+
+        while not finished:
+            try:
+                # only block when there is nothing to flush
+                item = self._embed_q.get(block=not pending)
+            except queue.Empty:
+                item = None
+
+            if item is _DONE:
+                finished = True
+            elif item is not None:
+                try:
+                    spans = chunk_text_spans(item.text)
+                    chunks = [item.text[s:e] for s, e in spans]
+                    pending.append((item, spans, chunks))
+                    n_pending += len(chunks)
+                except Exception as e:
+                    item.fail(e)
+
+            # flush when the batch is full or no more documents are ready yet
+            if pending and (item is None or finished or n_pending >= INGEST_EMBED_BATCH):
+                self._flush_embeddings(embedder, pending)
+                pending, n_pending = [], 0
+
+        for _ in range(INGEST_PLAN_WORKERS):
+            self._plan_q.put(_DONE)
+
+    def _flush_embeddings(self, embedder, pending: List[Any]) -> None:
+        texts = [c for _, _, chunks in pending for c in chunks]
+        try:
+            vectors = np.zeros((0, 1), dtype=np.float32)
+            if texts:
+                vectors = np.asarray(embedder.encode(texts, show_progress_bar=False), dtype=np.float32)
+        except Exception as e:
+            for item, _, _ in pending:
+                item.fail(e)
+            return
+
+        offset = 0
+        for item, spans, chunks in pending:
+            doc_vectors = vectors[offset : offset + len(chunks)]
+            offset += len(chunks)
+            try:
+                if not chunks:
+                    raise ValueError("no text could be extracted from the PDF")
+                index = build_flat_index(doc_vectors)
+                save_rag_index(item.lesson_id, index, chunks, spans)
+                item.enter("waiting_for_llm")
+                self._plan_q.put((item, index, chunks, spans))
+            except Exception as e:
+                item.fail(e)
+
+    def _plan_worker(self) -> None:
+        while True:
+            work = self._plan_q.get()
+            if work is _DONE:
+                return
+            item, index, chunks, spans = work
+            try:
+                item.enter("planning")
+                plan = generate_lesson_plan_from_text(
+                    item.title, item.text, planning=(index, chunks, spans)
+                )
+                item.llm = last_call_stats()
+                save_lesson_plan(item.title, plan)
+                item.text = ""
+                item.enter("done")
+            except Exception as e:
+                item.fail(e)
+
+    def run(self) -> None:
+        threads = [
+            threading.Thread(target=self._extract_stage, daemon=True),
+            threading.Thread(target=self._embed_stage, daemon=True),
+        ]
+        threads += [
+            threading.Thread(target=self._plan_worker, daemon=True)
+            for _ in range(INGEST_PLAN_WORKERS)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.finished = time.time()
+        print(f"📚 Course ingestion {self.job_id}: {self.summary()}")
+
+    # ---------- reporting ----------
+
+    def summary(self) -> Dict[str, Any]:
+        end = self.finished or time.time()
+        llm_seconds = sum(f.llm.get("llm_seconds", 0.0) for f in self.files)
+        return {
+            "files": len(self.files),
+            "done": sum(1 for f in self.files if f.stage == "done"),
+            "failed": sum(1 for f in self.files if f.stage == "error"),
+            "elapsed_seconds": round(end - self.started, 2),
+            "llm_seconds": round(llm_seconds, 2),
+            "llm_bound_seconds": round(llm_seconds / max(OLLAMA_CONCURRENCY, 1), 2),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "status": "finished" if self.finished else "receiving" if self.receiving else "running",
+            "summary": self.summary(),
+            "files": [f.to_dict() for f in self.files],
+        }
+
+
+def open_course_ingestion() -> IngestJob:
+    """
+    Start an empty pipeline that processes files as they are added with
+    job.add_file(); call job.close() once the last file is in.
+    """
+    _prune_jobs()
+    job = IngestJob()
+    _jobs[job.job_id] = job
+    threading.Thread(target=job.run, daemon=True).start()
+    return job
+
+
+def get_ingest_job(job_id: str) -> Optional[IngestJob]:
+    return _jobs.get(job_id)
+
+
+def _prune_jobs() -> None:
+    """
+    Forget finished jobs older than INGEST_JOB_TTL_SECONDS, then the oldest
+    finished ones beyond INGEST_MAX_JOBS. Running jobs are always kept.
+    """
+    now = time.time()
+    finished = sorted(
+        (job for job in list(_jobs.values()) if job.finished is not None),
+        key=lambda job: job.finished,
+    )
+    excess = len(_jobs) - INGEST_MAX_JOBS + 1  # room for the job being opened
+    for job in finished:
+        if now - job.finished > INGEST_JOB_TTL_SECONDS or excess > 0:
+            _jobs.pop(job.job_id, None)
+            excess -= 1
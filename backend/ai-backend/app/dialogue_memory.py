@@ -0,0 +1,159 @@
+# app/dialogue_memory.py
+
+"""
+Per-session dialogue memory for student questions, kept under a fixed
+token budget so prompt size (and prefill time) stays flat as a session
+grows:
+
+- the most recent turns are kept verbatim while they fit the budget;
+- older turns are folded into a rolling summary by a BACKGROUND-priority
+  LLM call in a worker thread, never on the request path;
+- until that summary lands, overflowed turns are simply left out of the
+  prompt (they are not re-added verbatim).
+"""
+
+import threading
+from typing import Any, Dict, List, Tuple
+
+from app.config import DIALOGUE_MEMORY_TOKENS, DIALOGUE_SUMMARY_TOKENS
+from app.llm_scheduler import BACKGROUND
+from app.ollama_client import query_ollama
+
+# rough chars per token (phi3 / English prose); budgets only need to be stable
+_CHARS_PER_TOKEN = 4
+# turns awaiting summarization kept if the summarizer keeps failing
+_MAX_PENDING = 8
+
+_totals_lock = threading.Lock()
+_totals = {"summaries": 0, "summary_failures": 0, "turns_summarized": 0}
+
+Turn = Tuple[str, str]
+
+_SUMMARY_SYSTEM_PROMPT = """
+You keep a running summary of a tutoring conversation between a student
+and an AI tutor.
+
+Rules:
+- Merge the new exchanges into the existing summary.
+- Keep what the student asked, what was explained, and anything they
+  found confusing or asked to have simplified.
+- Plain prose, no lists, no preamble.
+"""
+
+
+def _tokens(text: str) -> int:
+    return len(text) // _CHARS_PER_TOKEN + 1
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * _CHARS_PER_TOKEN
+    return text if len(text) <= max_chars else text[: max_chars - 1].rstrip() + "…"
+
+
+class DialogueMemory:
+    def __init__(
+        self,
+        session_id: str,
+        budget_tokens: int = DIALOGUE_MEMORY_TOKENS,
+        summary_tokens: int = DIALOGUE_SUMMARY_TOKENS,
+    ):
+        self.session_id = session_id
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = min(summary_tokens, budget_tokens // 2)
+        self.summary = ""
+        self._recent: List[Turn] = []
+        self._pending: List[Turn] = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+    # ---------- request path ----------
+
+    def messages(self) -> List[Dict[str, str]]:
+        """History to put before the new question: summary + recent turns."""
+        with self._lock:
+            out: List[Dict[str, str]] = []
+            if self.summary:
+                out.append(
+                    {"role": "system", "content": f"Summary of the conversation so far: {self.summary}"}
+                )
+            for question, answer in self._recent:
+                out.append({"role": "user", "content": question})
+                out.append({"role": "assistant", "content": answer})
+            return out
+
+    def add(self, question: str, answer: str) -> None:
+        """Record a finished turn; overflow is handed to the background summarizer."""
+        # one turn may never take more than half of the verbatim budget, counted
+        # the way _recent_tokens() counts it (_tokens adds 1 per message)
+        per_turn = max((self.budget_tokens - self.summary_tokens) // 2 - 2, 16)
+        question = _clip(question.strip(), per_turn // 3)
+        answer = _clip(answer.strip(), per_turn - len(question) // _CHARS_PER_TOKEN)
+
+        with self._lock:
+            self._recent.append((question, answer))
+            verbatim_budget = self.budget_tokens - self.summary_tokens
+            while len(self._recent) > 1 and self._recent_tokens() > verbatim_budget:
+                self._pending.append(self._recent.pop(0))
+            if not self._pending or self._summarizing:
+                return
+            self._summarizing = True
+        threading.Thread(target=self._summarize, daemon=True).start()
+
+    def tokens(self) -> int:
+        with self._lock:
+            return _tokens(self.summary) + self._recent_tokens()
+
+    def _recent_tokens(self) -> int:
+        return sum(_tokens(q) + _tokens(a) for q, a in self._recent)
+
+    # ---------- background ----------
+
+    def _summarize(self) -> None:
+        while True:
+            with self._lock:
+                batch = list(self._pending)
+                summary = self.summary
+                if not batch:
+                    self._summarizing = False
+                    return
+
+            exchanges = "\n".join(f"Student: {q}\nTutor: {a}" for q, a in batch)
+            words = self.summary_tokens * 3 // 4
+            try:
+                updated = query_ollama(
+                    [
+                        {"role": "system", "content": _SUMMARY_SYSTEM_PROMPT},
+                        {
+                            "role": "user",
+                            "content": (
+                                f"Existing summary:\n{summary or '(none)'}\n\n"
+                                f"New exchanges:\n{exchanges}\n\n"
+                                f"Return ONLY the updated summary, at most {words} words."
+                            ),
+                        },
+                    ],
+                    priority=BACKGROUND,
+                    key=self.session_id,
+                ).strip()
+            except Exception as e:
+                updated = ""
+                print(f"[WARN] Dialogue summary failed for session '{self.session_id}': {e}")
+
+            with self._lock:
+                if not updated:
+                    # try again with the next overflow; don't let the backlog grow
+                    self._pending = self._pending[-_MAX_PENDING:]
+                    self._summarizing = False
+                    with _totals_lock:
+                        _totals["summary_failures"] += 1
+                    return
+                self.summary = _clip(updated, self.summary_tokens)
+                del self._pending[: len(batch)]
+            with _totals_lock:
+                _totals["summaries"] += 1
+                _totals["turns_summarized"] += len(batch)
+
+
+def dialogue_stats() -> Dict[str, Any]:
+    with _totals_lock:
+        return dict(_totals)
@@ -0,0 +1,307 @@
+# app/embed_service.py
+
+"""
+Optional shared embedding service for multi-worker deployments.
+
+Instead of every uvicorn worker loading its own SentenceTransformer (and
+torch runtime), one local process owns the model and all workers send
+encode requests to it:
+
+    python -m app.embed_service          # or run.py with EMBED_SERVICE=1
+    EMBED_SERVICE=1 uvicorn app.api:app --workers 8
+
+Transport is multiprocessing.connection (Unix socket on POSIX, named pipe
+on Windows). Only the texts travel over the socket: each client thread owns
+a shared-memory segment and the service writes the vectors straight into
+it, so results are never pickled. Requests from all workers are gathered
+for up to EMBED_BATCH_WAIT_MS and encoded as one batch.
+
+Service and clients must share EMBED_SERVICE_AUTHKEY (run.py generates one
+per launch); the POSIX socket lives in a directory only this user can open.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from multiprocessing import connection, shared_memory
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.config import (
+    EMBED_BATCH_WAIT_MS,
+    EMBED_MAX_BATCH,
+    EMBED_MODEL_NAME,
+    EMBED_SERVICE_ADDRESS,
+    EMBED_SERVICE_AUTHKEY,
+)
+
+
+def _authkey() -> bytes:
+    if not EMBED_SERVICE_AUTHKEY:
+        raise RuntimeError(
+            "EMBED_SERVICE_AUTHKEY is not set; give the embedding service and every "
+            "API worker the same secret (run.py generates one when EMBED_SERVICE=1)"
+        )
+    return EMBED_SERVICE_AUTHKEY
+
+
+def _private_socket_dir(address: str) -> None:
+    """Create the socket's directory 0700; refuse one owned by another user."""
+    directory = os.path.dirname(address)
+    if not directory:
+        return
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid():
+        raise RuntimeError(f"Embedding service socket dir {directory} is not owned by this user")
+    if st.st_mode & 0o077:
+        os.chmod(directory, 0o700)
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # the client owns the segment; don't let this process' tracker unlink it
+    try:
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+# ---------- SERVER ----------
+
+class _Request:
+    def __init__(self, texts: List[str], shm: shared_memory.SharedMemory):
+        self.texts = texts
+        self.shm = shm
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class EmbeddingServer:
+    def __init__(self, address: str = EMBED_SERVICE_ADDRESS):
+        from app.embedders import load_embedder
+
+        self.authkey = _authkey()  # fail before loading the model
+        self.address = address
+        self.model = load_embedder()
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self.batches = 0
+        self.texts = 0
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "model": EMBED_MODEL_NAME,
+            "backend": self.model.backend,
+            "dim": self.dim,
+            "max_seq_length": self.model.max_seq_length,
+            "batches": self.batches,
+            "texts": self.texts,
+        }
+
+    def serve_forever(self) -> None:
+        if not self.address.startswith("\\\\"):
+            _private_socket_dir(self.address)
+            if os.path.exists(self.address):
+                os.remove(self.address)  # stale socket from a previous run
+        listener = connection.Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        print(
+            f"🧮 Embedding service ({EMBED_MODEL_NAME} [{self.model.backend}], dim={self.dim}) on {self.address}"
+        )
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"[WARN] embed service accept failed: {e}")
+                continue
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn) -> None:
+        """One thread per client connection (= per worker thread)."""
+        shm: Optional[shared_memory.SharedMemory] = None
+        try:
+            while True:
+                msg = conn.recv()
+                if msg[0] == "info":
+                    conn.send(("ok", self.info()))
+                    continue
+
+                _, texts, shm_name = msg
+                if shm is None or shm.name != shm_name:
+                    if shm is not None:
+                        shm.close()
+                    shm = _attach(shm_name)
+
+                req = _Request(texts, shm)
+                self._queue.put(req)
+                req.done.wait()
+                if req.error:
+                    conn.send(("error", req.error))
+                else:
+                    conn.send(("ok", len(texts), self.dim))
+        except (EOFError, OSError):
+            pass
+        finally:
+            if shm is not None:
+                shm.close()
+            conn.close()
+
+    def _batch_loop(self) -> None:
+        wait = EMBED_BATCH_WAIT_MS / 1000.0
+        while True:
+            batch = [self._queue.get()]
+            n_texts = len(batch[0].texts)
+            deadline = time.monotonic() + wait
+            # gather concurrent requests from all workers into one encode call
+            while n_texts < EMBED_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    req = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(req)
+                n_texts += len(req.texts)
+
+            texts = [t for req in batch for t in req.texts]
+            try:
+                vectors = self.model.encode(texts, show_progress_bar=False, convert_to_numpy=True)
+                vectors = np.asarray(vectors, dtype=np.float32)
+                offset = 0
+                for req in batch:
+                    n = len(req.texts)
+                    out = np.ndarray((n, self.dim), dtype=np.float32, buffer=req.shm.buf)
+                    out[:] = vectors[offset : offset + n]
+                    offset += n
+                    del out  # release the buffer export so the segment can be closed
+                self.batches += 1
+                self.texts += len(texts)
+            except Exception as e:
+                for req in batch:
+                    req.error = str(e)
+            finally:
+                for req in batch:
+                    req.done.set()
+
+
+# ---------- CLIENT ----------
+
+class RemoteEmbedder:
+    """
+    Drop-in for the SentenceTransformer methods this app uses
+    (encode, tokenizer, max_seq_length), backed by the shared service.
+    """
+
+    def __init__(self, address: str = EMBED_SERVICE_ADDRESS):
+        self.address = address
+        self._local = threading.local()
+        self._segments: List[shared_memory.SharedMemory] = []
+        self._segments_lock = threading.Lock()
+        self._tokenizer = None
+        _, self._info = self._call(("info",))
+        atexit.register(self._cleanup)
+
+    @property
+    def signature(self) -> Dict[str, Any]:
+        """Model and backend the service embeds with (recorded per lesson)."""
+        return {"model": self._info["model"], "backend": self._info.get("backend", "torch")}
+
+    @property
+    def max_seq_length(self) -> int:
+        return self._info["max_seq_length"]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._info["dim"]
+
+    @property
+    def tokenizer(self):
+        # tokenizer only (no model weights), for token-aware chunking
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+
+            self._tokenizer = AutoTokenizer.from_pretrained(
+                f"sentence-transformers/{self._info['model']}"
+            )
+        return self._tokenizer
+
+    def _conn(self, wait_s: float = 30.0):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            deadline = time.monotonic() + wait_s
+            while True:
+                try:
+                    conn = connection.Client(self.address, authkey=_authkey())
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    # service may still be loading the model
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.5)
+            self._local.conn = conn
+        return conn
+
+    def _call(self, msg):
+        try:
+            conn = self._conn()
+            conn.send(msg)
+            reply = conn.recv()
+        except (EOFError, OSError):
+            # service restarted: reconnect once
+            self._local.conn = None
+            conn = self._conn()
+            conn.send(msg)
+            reply = conn.recv()
+        if reply[0] == "error":
+            raise RuntimeError(f"Embedding service error: {reply[1]}")
+        return reply
+
+    def _buffer(self, n_bytes: int) -> shared_memory.SharedMemory:
+        """This thread's result segment, grown (doubling) when too small."""
+        shm = getattr(self._local, "shm", None)
+        if shm is None or shm.size < n_bytes:
+            size = max(n_bytes, 2 * shm.size if shm is not None else 1 << 20)
+            new = shared_memory.SharedMemory(create=True, size=size)
+            with self._segments_lock:
+                if shm is not None:
+                    self._release(shm)
+                self._segments.append(new)
+            self._local.shm = shm = new
+        return shm
+
+    def encode(self, sentences, show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        dim = self._info["dim"]
+        if not texts:
+            return np.zeros((0, dim), dtype=np.float32)
+
+        shm = self._buffer(len(texts) * dim * 4)
+        _, n, dim = self._call(("encode", texts, shm.name))
+        # one memcpy out of the segment; it is reused by this thread's next call
+        vectors = np.ndarray((n, dim), dtype=np.float32, buffer=shm.buf).copy()
+        return vectors[0] if single else vectors
+
+    def _release(self, shm: shared_memory.SharedMemory) -> None:
+        self._segments.remove(shm)
+        shm.close()
+        shm.unlink()
+
+    def _cleanup(self) -> None:
+        with self._segments_lock:
+            for shm in list(self._segments):
+                try:
+                    self._release(shm)
+                except Exception:
+                    pass
+
+
+if __name__ == "__main__":
+    EmbeddingServer().serve_forever()
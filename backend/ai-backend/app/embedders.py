@@ -0,0 +1,106 @@
+# app/embedders.py
+
+"""
+Pluggable sentence-embedder backends, selected by EMBED_BACKEND:
+
+- "torch"      full-precision PyTorch (the original path)
+- "onnx"       ONNX Runtime, fp32 export of the same model
+- "onnx-int8"  ONNX Runtime, dynamically int8-quantized export
+
+The ONNX paths use sentence-transformers' own backend support (needs
+`optimum[onnxruntime]`); all-MiniLM-L6-v2 ships both the fp32 and
+quantized ONNX files, so nothing is exported at startup.
+
+Vectors from different backends are close but not identical, so every
+lesson records the signature ({model, backend}) it was built with and is
+only searched with a matching embedder.
+"""
+
+from typing import Any, Dict, List
+
+from app.config import (
+    EMBED_BACKEND,
+    EMBED_BATCH_SIZE,
+    EMBED_MODEL_NAME,
+    EMBED_ONNX_INT8_FILE,
+    EMBED_THREADS,
+)
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# lessons indexed before embedding.json existed
+LEGACY_SIGNATURE: Dict[str, Any] = {"model": "all-MiniLM-L6-v2", "backend": "torch"}
+
+
+class EmbeddingMismatchError(ValueError):
+    """A lesson index was built with a different embedder than the running one."""
+
+
+class BackendEmbedder:
+    """
+    SentenceTransformer with a fixed backend, thread count and batch size.
+    Exposes encode / tokenizer / max_seq_length like the wrapped model.
+    """
+
+    def __init__(self, model, backend: str, batch_size: int):
+        self.model = model
+        self.backend = backend
+        self.batch_size = batch_size
+        self.signature: Dict[str, Any] = {"model": EMBED_MODEL_NAME, "backend": backend}
+
+    def encode(self, sentences, show_progress_bar: bool = False, **kwargs):
+        kwargs.setdefault("batch_size", self.batch_size)
+        return self.model.encode(sentences, show_progress_bar=show_progress_bar, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self.model, name)
+
+
+def _ort_session_options(threads: int):
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    if threads > 0:
+        opts.intra_op_num_threads = threads
+        opts.inter_op_num_threads = 1
+    return opts
+
+
+def load_embedder(
+    backend: str = EMBED_BACKEND,
+    threads: int = EMBED_THREADS,
+    batch_size: int = EMBED_BATCH_SIZE,
+) -> BackendEmbedder:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBED_BACKEND '{backend}', expected one of {BACKENDS}")
+
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch":
+        if threads > 0:
+            import torch
+
+            torch.set_num_threads(threads)
+        model = SentenceTransformer(EMBED_MODEL_NAME)
+    else:
+        model_kwargs: Dict[str, Any] = {
+            "provider": "CPUExecutionProvider",
+            "session_options": _ort_session_options(threads),
+        }
+        if backend == "onnx-int8":
+            model_kwargs["file_name"] = EMBED_ONNX_INT8_FILE
+        model = SentenceTransformer(EMBED_MODEL_NAME, backend="onnx", model_kwargs=model_kwargs)
+
+    print(f"🧮 Embedder: {EMBED_MODEL_NAME} [{backend}], threads={threads or 'default'}, batch={batch_size}")
+    return BackendEmbedder(model, backend, batch_size)
+
+
+def check_signature(lesson_id: str, built_with: Dict[str, Any], running: Dict[str, Any]) -> None:
+    keys: List[str] = ["model", "backend"]
+    if any(built_with.get(k) != running.get(k) for k in keys):
+        raise EmbeddingMismatchError(
+            f"Lesson '{lesson_id}' was indexed with {built_with.get('model')} "
+            f"[{built_with.get('backend')}] but this server embeds with "
+            f"{running.get('model')} [{running.get('backend')}]; rebuild the lesson "
+            "or set EMBED_BACKEND to match."
+        )
@@ -1,92 +1,172 @@
 # app/lesson_plan.py
 
 import json
+import math
 import os
-from typing import Any, Dict, List, Tuple
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
 import time
 
 import faiss
 import numpy as np
 
-from app.config import BASE_LESSON_DIR
-from app.ollama_client import query_ollama, extract_json_from_model_output
-from app.rag import get_embedder, chunk_text
+from app.config import (
+    BASE_LESSON_DIR,
+    MAX_PROMPT_CHARS,
+    PLANNING_BATCH,
+    PLANNING_CONTEXT_CHARS,
+    PLANNING_MIN_SUBTOPIC_CHARS,
+)
+from app.llm_scheduler import BACKGROUND, last_wait_seconds
+from app.ollama_client import query_ollama_json
+from app.lexical import BM25Index
+from app.context_pack import pack_context
+from app.rag import build_flat_index, encode_query, get_embedder, chunk_text_spans
+from app.speech_formatter import save_lesson_speech
 
 
 def slugify(text: str) -> str:
     return "".join(c.lower() if c.isalnum() else "_" for c in text).strip("_")
 
 
+def unique_title(title: str, taken: Set[str]) -> str:
+    """
+    `title`, or "title 2", "title 3", ... so that its slug is not in
+    `taken` (lesson ids already used by the same upload / job).
+    """
+    candidate, n = title, 1
+    while slugify(candidate) in taken:
+        n += 1
+        candidate = f"{title} {n}"
+    return candidate
+
+
 # ---------- PLANNING RAG INDEX (in-memory) ----------
 
-def build_planning_index(doc_text: str) -> Tuple[faiss.Index, List[str]]:
+def build_planning_index(doc_text: str) -> Tuple[faiss.Index, List[str], List[Tuple[int, int]]]:
     """
     Build an in-memory FAISS index for planning (topics/subtopics/micro-sections).
     Uses the same embedder + chunking as runtime RAG.
     """
-    chunks = chunk_text(doc_text, chunk_size=800, overlap=200)
+    spans = chunk_text_spans(doc_text)
+    chunks = [doc_text[s:e] for s, e in spans]
     if not chunks:
-        chunks = [doc_text]
+        chunks, spans = [doc_text], [(0, len(doc_text))]
 
     embedder = get_embedder()
     vectors = embedder.encode(chunks, show_progress_bar=False)
-    vectors = np.asarray(vectors, dtype=np.float32)
-
-    dim = vectors.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    faiss.normalize_L2(vectors)
-    index.add(vectors)
-
-    return index, chunks
+    return build_flat_index(vectors), chunks, spans
 
 
 def planning_search(
     index: faiss.Index,
     chunks: List[str],
     query: str,
-    min_chars: int = 900,
-    initial_k: int = 6,
+    budget_chars: int = PLANNING_CONTEXT_CHARS,
+    lexical: Optional[BM25Index] = None,
+    spans: Optional[List[Tuple[int, int]]] = None,
+    q_vec: Optional[np.ndarray] = None,
 ) -> str:
     """
-    Get relevant text for planning:
-    – start with k chunks
-    – if too short, increase k
+    Get relevant text for planning in one search pass (hybrid when `lexical`
+    is given): diverse chunks up to `budget_chars`, with overlapping chunks
+    merged back into contiguous passages.
     """
+    return planning_search_ids(index, chunks, query, budget_chars, lexical, spans, q_vec)[0]
+
+
+def planning_search_ids(
+    index: faiss.Index,
+    chunks: List[str],
+    query: str,
+    budget_chars: int = PLANNING_CONTEXT_CHARS,
+    lexical: Optional[BM25Index] = None,
+    spans: Optional[List[Tuple[int, int]]] = None,
+    q_vec: Optional[np.ndarray] = None,
+) -> Tuple[str, List[int]]:
+    """Same as planning_search, plus the ids of the chunks the text came from."""
     if not chunks:
-        return ""
+        return "", []
+
+    # naive_*: the old planning_search sent the top 6 chunks, or 12 if under 900 chars
+    passages, stats = pack_context(
+        index,
+        chunks,
+        query,
+        budget_chars,
+        lexical=lexical,
+        spans=spans,
+        q_vec=q_vec,
+        naive_k=6,
+        naive_min_chars=900,
+    )
+    return "\n\n".join(passages), stats["chunk_ids"]
 
-    embedder = get_embedder()
-    q_vec = embedder.encode([query], show_progress_bar=False)
-    q_vec = np.asarray(q_vec, dtype=np.float32)
-    faiss.normalize_L2(q_vec)
 
-    k = min(initial_k, len(chunks))
-    D, I = index.search(q_vec, k)
-    selected = [chunks[i] for i in I[0]]
-    context = "\n\n".join(selected)
+# ---------- COMMON LLM HELPERS ----------
 
-    if len(context) < min_chars and k < len(chunks):
-        k2 = min(k * 2, len(chunks))
-        D, I = index.search(q_vec, k2)
-        selected = [chunks[i] for i in I[0]]
-        context = "\n\n".join(selected)
+def _is_string_list(value: Any) -> bool:
+    return isinstance(value, list) and any(isinstance(v, str) for v in value)
 
-    return context
 
+def _is_object(value: Any) -> bool:
+    return isinstance(value, dict)
 
-# ---------- COMMON LLM HELPERS ----------
 
-def _llm_json_call(system_prompt: str, user_prompt: str, desc: str, max_retries: int = 2):
+# per-thread LLM call counter, so each plan generation can report its own cost
+_call_stats = threading.local()
+
+
+def _reset_call_stats(key: Optional[str] = None) -> None:
+    # key groups this plan's calls for fair scheduling across lessons
+    _call_stats.key = key
+    _call_stats.calls = 0
+    _call_stats.batched = 0
+    _call_stats.seconds = 0.0
+    _call_stats.wait = 0.0
+
+
+def last_call_stats() -> Dict[str, float]:
+    """LLM cost of the last plan generated on this thread."""
+    return {
+        "llm_calls": getattr(_call_stats, "calls", 0),
+        "batched_topics": getattr(_call_stats, "batched", 0),
+        "llm_seconds": round(getattr(_call_stats, "seconds", 0.0), 2),
+        "llm_wait_seconds": round(getattr(_call_stats, "wait", 0.0), 2),
+    }
+
+
+def _record_call(seconds: float) -> None:
+    # split scheduler queue wait from actual generation time
+    wait = min(last_wait_seconds(), seconds)
+    _call_stats.calls = getattr(_call_stats, "calls", 0) + 1
+    _call_stats.seconds = getattr(_call_stats, "seconds", 0.0) + seconds - wait
+    _call_stats.wait = getattr(_call_stats, "wait", 0.0) + wait
+
+
+def _llm_json_call(
+    system_prompt: str,
+    user_prompt: str,
+    desc: str,
+    max_retries: int = 2,
+    format: Optional[Any] = None,
+    validate=_is_string_list,
+):
     last_raw = ""
     for attempt in range(max_retries + 1):
-        raw = query_ollama(
+        started = time.time()
+        data, raw = query_ollama_json(
             [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
-            ]
+            ],
+            format=format,
+            validate=validate,
+            priority=BACKGROUND,
+            key=getattr(_call_stats, "key", None),
         )
+        _record_call(time.time() - started)
         last_raw = raw
-        data = extract_json_from_model_output(raw)
         if data is not None:
             return data
     # if everything failed, return None; caller decides fallback
@@ -114,7 +194,7 @@ def _fallback_topics_from_text(doc_text: str, max_topics: int = 5) -> List[str]:
     """
     If the model fails to generate topics, fall back to naive chunk-based parts.
     """
-    chunks = chunk_text(doc_text, chunk_size=2500, overlap=300)
+    chunks = chunk_text_spans(doc_text, max_tokens=600, overlap_tokens=75)
     if not chunks:
         return ["Overview"]
     n = min(len(chunks), max_topics)
@@ -255,9 +335,160 @@ Rules:
     return micro_sections
 
 
+# ---------- PASS 3 (BATCHED): ALL SUBTOPICS OF A TOPIC IN ONE CALL ----------
+
+_BATCH_MICRO_SYSTEM_PROMPT = """
+You are an AI tutor speaking to a student.
+
+Task:
+- For the given TOPIC, you receive several SUBTOPICS, each with its own
+  document excerpt.
+- For EVERY subtopic, generate a sequence of micro-lessons.
+- Each micro-lesson is 2–3 SHORT sentences.
+- Speak in a friendly, conversational tone (like a real tutor).
+- Progress from basic idea to slightly deeper understanding.
+
+Rules:
+- Return ONLY a JSON object: {"subtopics": [{"title": "...", "micro_sections": ["...", "..."]}]}
+- Keep the subtopics in the same order as given, one entry per subtopic.
+- Copy each subtopic title exactly as given into "title".
+- Use ONLY information from each subtopic's own excerpt.
+- You may rephrase and simplify, but do NOT add external facts.
+- Aim for 3 to 7 micro-lessons per subtopic.
+"""
+
+_BATCH_MICRO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "subtopics": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "micro_sections": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["title", "micro_sections"],
+            },
+        }
+    },
+    "required": ["subtopics"],
+}
+
+
+def _normalize_title(title: str) -> str:
+    return " ".join(title.split()).casefold()
+
+
+def _batch_overhead(topic_title: str) -> int:
+    return len(_BATCH_MICRO_SYSTEM_PROMPT) + len(topic_title) + 200
+
+
+def _subtopic_prompt_chars(s_title: str, context_text: str) -> int:
+    return len(s_title) + 60 + len(context_text)
+
+
+def plan_topic_batches(topic_title: str, subtopics: List[str]) -> List[Tuple[List[int], int]]:
+    """
+    Split a topic's subtopics into balanced consecutive groups, one LLM
+    call each, as (subtopic indices, excerpt_chars). Every subtopic of a
+    group gets its own context pass of `excerpt_chars` so the combined
+    prompt fits MAX_PROMPT_CHARS; groups are as large as possible while
+    each excerpt keeps at least PLANNING_MIN_SUBTOPIC_CHARS. A group of one
+    is planned per-subtopic with the full PLANNING_CONTEXT_CHARS excerpt.
+    """
+    n = len(subtopics)
+    if n < 2:
+        return [([i], PLANNING_CONTEXT_CHARS) for i in range(n)]
+
+    room = MAX_PROMPT_CHARS - _batch_overhead(topic_title)
+    per_title = max(_subtopic_prompt_chars(s, "") for s in subtopics)
+
+    def excerpt_chars(size: int) -> int:
+        return min(room // size - per_title, PLANNING_CONTEXT_CHARS)
+
+    size = n
+    while size > 1 and excerpt_chars(size) < PLANNING_MIN_SUBTOPIC_CHARS:
+        size -= 1
+    if size < 2:
+        return [([i], PLANNING_CONTEXT_CHARS) for i in range(n)]
+
+    # ceil(n / size) calls, with sizes as even as possible (5 -> 3 + 2, not 4 + 1)
+    n_groups = math.ceil(n / size)
+    base, extra = divmod(n, n_groups)
+    groups: List[Tuple[List[int], int]] = []
+    start = 0
+    for g in range(n_groups):
+        g_size = base + (1 if g < extra else 0)
+        budget = excerpt_chars(g_size) if g_size > 1 else PLANNING_CONTEXT_CHARS
+        groups.append((list(range(start, start + g_size)), budget))
+        start += g_size
+    return groups
+
+
+def generate_topic_micro_sections(
+    topic_title: str,
+    subtopics: List[str],
+    contexts: List[str],
+) -> Optional[List[Optional[List[str]]]]:
+    """
+    Generate micro-sections for several subtopics of a topic in one
+    schema-constrained call (Ollama `format`).
+
+    Returns None when the excerpts don't fit MAX_PROMPT_CHARS together
+    (see plan_topic_batches) or the call failed; otherwise one entry per
+    subtopic, matched on the returned title. An entry is None if the model
+    skipped or renamed that subtopic (caller falls back per-subtopic).
+    """
+    needed = _batch_overhead(topic_title) + sum(
+        _subtopic_prompt_chars(s, c) for s, c in zip(subtopics, contexts)
+    )
+    if needed > MAX_PROMPT_CHARS:
+        return None
+
+    parts = [f"TOPIC: {topic_title}\n"]
+    for i, (s_title, ctx) in enumerate(zip(subtopics, contexts), start=1):
+        parts.append(f"SUBTOPIC {i}: {s_title}\nExcerpt:\n{ctx}\n")
+    parts.append("Now return ONLY the JSON object with micro-lessons for every subtopic.")
+    user_prompt = "\n".join(parts)
+
+    raw = _llm_json_call(
+        _BATCH_MICRO_SYSTEM_PROMPT,
+        user_prompt,
+        desc=f"batched micro sections for '{topic_title}'",
+        max_retries=0,
+        format=_BATCH_MICRO_SCHEMA,
+        validate=_is_object,
+    )
+    if not isinstance(raw, dict) or not isinstance(raw.get("subtopics"), list):
+        return None
+
+    _call_stats.batched = getattr(_call_stats, "batched", 0) + 1
+    by_title: Dict[str, Any] = {}
+    for entry in raw["subtopics"]:
+        if isinstance(entry, dict) and isinstance(entry.get("title"), str):
+            by_title.setdefault(_normalize_title(entry["title"]), entry)
+
+    results: List[Optional[List[str]]] = []
+    for s_title in subtopics:
+        entry = by_title.get(_normalize_title(s_title))
+        micro = _clean_string_list(
+            entry.get("micro_sections") if entry is not None else None,
+            max_items=7,
+            label="micro",
+        )
+        results.append(micro or None)
+    time.sleep(0.25)
+    return results
+
+
 # ---------- FULL LESSON PLAN GENERATION PIPELINE ----------
 
-def generate_lesson_plan_from_text(lesson_title: str, doc_text: str) -> Dict[str, Any]:
+def generate_lesson_plan_from_text(
+    lesson_title: str,
+    doc_text: str,
+    planning: Optional[Tuple[faiss.Index, List[str], List[Tuple[int, int]]]] = None,
+) -> Dict[str, Any]:
     """
     Build a hierarchical lesson plan:
     {
@@ -266,25 +497,41 @@ def generate_lesson_plan_from_text(lesson_title: str, doc_text: str) -> Dict[str
         {
           "topic_id": 1,
           "title": "...",
+          "chunk_ids": [3, 4, 9],
           "subtopics": [
             {
               "sub_id": 1,
               "title": "...",
-              "micro_sections": ["...", "..."]
+              "micro_sections": ["...", "..."],
+              "chunk_ids": [3, 4]
             }
           ]
         }
       ]
     }
 
+    chunk_ids are the planning chunks that grounded each topic / subtopic
+    (the lesson's RAG chunks, same chunker); save_lesson_plan moves them to
+    topic_chunks.json for topic-scoped retrieval at question time.
+
     Flow:
-    1) Build in-memory planning index from full text.
+    1) Build in-memory planning index from full text
+       (or reuse `planning` = (index, chunks, spans) from the lesson's RAG index).
     2) Generate topics (global, with fallbacks).
     3) For each topic, use planning RAG to get context.
-    4) For each subtopic, get refined context and generate tutor-style micro-sections.
+    4) For each subtopic, get refined context and generate tutor-style micro-sections
+       (batched: a few subtopics per call, each with a smaller excerpt; any
+       subtopic a batch misses falls back to its own call).
     """
+    _reset_call_stats(key=lesson_title)
+    started = time.time()
+
     # 1) Planning index from full document
-    planning_index, planning_chunks = build_planning_index(doc_text)
+    if planning is not None and planning[1]:
+        planning_index, planning_chunks, planning_spans = planning
+    else:
+        planning_index, planning_chunks, planning_spans = build_planning_index(doc_text)
+    planning_lexical = BM25Index.build(planning_chunks)
 
     # 2) High-level topics (with robust fallback)
     topics = generate_topics(doc_text)
@@ -294,25 +541,72 @@ def generate_lesson_plan_from_text(lesson_title: str, doc_text: str) -> Dict[str
     for t_idx, t_title in enumerate(topics, start=1):
         # 3a) Topic-specific context
         topic_query = t_title
-        topic_context = planning_search(planning_index, planning_chunks, topic_query)
+        topic_context, topic_chunk_ids = planning_search_ids(
+            planning_index,
+            planning_chunks,
+            topic_query,
+            lexical=planning_lexical,
+            spans=planning_spans,
+        )
 
         # 3b) Subtopics grounded in topic context
         subtopics = generate_subtopics(t_title, topic_context)
         time.sleep(0.25)
         sub_objs: List[Dict[str, Any]] = []
 
-        for s_idx, s_title in enumerate(subtopics, start=1):
-            # 3c) Subtopic-specific context via planning RAG
-            sub_query = f"{t_title}. {s_title}"
-            micro_context = planning_search(planning_index, planning_chunks, sub_query)
+        # 3c) Subtopic-specific context via planning RAG (the full excerpt
+        #     also sets the chunks a subtopic's questions are scoped to)
+        queries = [f"{t_title}. {s_title}" for s_title in subtopics]
+        q_vecs = [encode_query(q) for q in queries]
+        searched = [
+            planning_search_ids(
+                planning_index,
+                planning_chunks,
+                query,
+                lexical=planning_lexical,
+                spans=planning_spans,
+                q_vec=q_vec,
+            )
+            for query, q_vec in zip(queries, q_vecs)
+        ]
+        contexts = [text for text, _ in searched]
+
+        # 3d) Micro-sections: several subtopics per call, each with its own
+        #     smaller context pass, so a topic fits one or two prompts
+        batched: List[Optional[List[str]]] = [None] * len(subtopics)
+        if PLANNING_BATCH:
+            for group, excerpt_chars in plan_topic_batches(t_title, subtopics):
+                if len(group) < 2:
+                    continue
+                excerpts = [
+                    planning_search(
+                        planning_index,
+                        planning_chunks,
+                        queries[i],
+                        excerpt_chars,
+                        lexical=planning_lexical,
+                        spans=planning_spans,
+                        q_vec=q_vecs[i],
+                    )
+                    for i in group
+                ]
+                results = generate_topic_micro_sections(
+                    t_title, [subtopics[i] for i in group], excerpts
+                )
+                for i, micro in zip(group, results or []):
+                    batched[i] = micro
 
-            micro_sections = generate_micro_sections(t_title, s_title, micro_context)
-            time.sleep(0.25)
+        for s_idx, s_title in enumerate(subtopics, start=1):
+            micro_sections = batched[s_idx - 1]
+            if not micro_sections:
+                micro_sections = generate_micro_sections(t_title, s_title, contexts[s_idx - 1])
+                time.sleep(0.25)
             sub_objs.append(
                 {
                     "sub_id": s_idx,
                     "title": s_title,
                     "micro_sections": micro_sections,
+                    "chunk_ids": searched[s_idx - 1][1],
                 }
             )
 
@@ -320,25 +614,76 @@ def generate_lesson_plan_from_text(lesson_title: str, doc_text: str) -> Dict[str
             {
                 "topic_id": t_idx,
                 "title": t_title,
+                "chunk_ids": sorted(set(topic_chunk_ids).union(*(ids for _, ids in searched))),
                 "subtopics": sub_objs,
             }
         )
 
-    plan: Dict[str, Any] = {"title": lesson_title, "topics": topic_objs}
+    plan: Dict[str, Any] = {
+        "title": lesson_title,
+        "topics": topic_objs,
+        "chunk_count": len(planning_chunks),
+    }
+    print(
+        f"📊 Planned '{lesson_title}': {_call_stats.calls} LLM calls "
+        f"({_call_stats.batched} batched topics), "
+        f"{_call_stats.seconds:.1f}s generating, {_call_stats.wait:.1f}s queued, "
+        f"{time.time() - started:.1f}s total."
+    )
     return plan
 
 
 # ---------- SAVE & LOAD ----------
 
+def _split_grounding(plan: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """
+    (plan without chunk ids, topic -> subtopic -> chunk ids mapping).
+    The mapping is positional like the plan; None if the plan has no ids.
+    """
+    if "chunk_count" not in plan:
+        return plan, None
+    grounding = {"chunk_count": plan["chunk_count"], "topics": []}
+    topics = []
+    for topic in plan["topics"]:
+        grounding["topics"].append(
+            {
+                "chunk_ids": topic.get("chunk_ids", []),
+                "subtopics": [sub.get("chunk_ids", []) for sub in topic["subtopics"]],
+            }
+        )
+        subtopics = [{k: v for k, v in sub.items() if k != "chunk_ids"} for sub in topic["subtopics"]]
+        topics.append({**{k: v for k, v in topic.items() if k != "chunk_ids"}, "subtopics": subtopics})
+    clean = {k: v for k, v in plan.items() if k != "chunk_count"}
+    clean["topics"] = topics
+    return clean, grounding
+
+
+def load_topic_chunks(lesson_id: str) -> Optional[Dict[str, Any]]:
+    """Topic/subtopic -> chunk ids mapping, or None for lessons saved before it."""
+    path = os.path.join(BASE_LESSON_DIR, lesson_id, "topic_chunks.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 def save_lesson_plan(lesson_title: str, plan: Dict[str, Any]) -> str:
     lesson_id = slugify(lesson_title)
     lesson_dir = os.path.join(BASE_LESSON_DIR, lesson_id)
     os.makedirs(lesson_dir, exist_ok=True)
 
+    plan, grounding = _split_grounding(plan)
+    if grounding is not None:
+        with open(os.path.join(lesson_dir, "topic_chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(grounding, f)
+
     path = os.path.join(lesson_dir, "plan.json")
     with open(path, "w", encoding="utf-8") as f:
         json.dump(plan, f, ensure_ascii=False, indent=2)
 
+    # TTS-ready text + SSML for every step, rendered once here
+    save_lesson_speech(lesson_id, plan)
+
     print(f"✅ Saved lesson plan -> {path}")
     return lesson_id
 
@@ -0,0 +1,179 @@
+# app/lexical.py
+
+"""
+BM25 inverted index over lesson chunks, used next to the FAISS index so
+exact terms (formula names, acronyms, chapter numbers) are not lost by
+dense retrieval.
+
+The index is stored in CSR form: the sorted vocabulary as one UTF-8 blob
+plus an offsets array, an `indptr` array into flat posting arrays of chunk
+ids and precomputed BM25 weights. A query term is found by binary search
+over the blob (no per-term Python strings are kept), then scoring is just
+a few slice-adds into a score vector.
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"\w+(?:[.\-]\w+)*")
+# longer "words" are hashes, base64 or URL debris from PDF extraction
+_MAX_TOKEN_CHARS = 40
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens; keeps '3.2', 'co-factor', 'h2o' as single terms."""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if len(t) <= _MAX_TOKEN_CHARS]
+
+
+def _pack_terms(terms: Sequence[str]) -> Tuple[bytes, np.ndarray]:
+    """Sorted terms -> (UTF-8 blob, offsets); term i is blob[offsets[i]:offsets[i + 1]]."""
+    encoded = [t.encode("utf-8") for t in terms]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in encoded], out=offsets[1:])
+    return b"".join(encoded), offsets
+
+
+class BM25Index:
+    def __init__(
+        self,
+        term_blob: bytes,
+        term_offsets: np.ndarray,
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        weights: np.ndarray,
+        n_docs: int,
+    ):
+        self.term_blob = term_blob
+        self.term_offsets = term_offsets
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @property
+    def n_terms(self) -> int:
+        return len(self.term_offsets) - 1
+
+    def _term(self, t_idx: int) -> bytes:
+        return self.term_blob[self.term_offsets[t_idx] : self.term_offsets[t_idx + 1]]
+
+    def term_id(self, term: str) -> Optional[int]:
+        # UTF-8 byte order == code point order, so the blob is sorted as bytes too
+        key = term.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.n_terms and self._term(lo) == key else None
+
+    @classmethod
+    def build(cls, chunks: Sequence[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        n_docs = len(chunks)
+        postings: Dict[str, Dict[int, int]] = {}
+        doc_len = np.zeros(max(n_docs, 1), dtype=np.float32)
+
+        for doc_id, chunk in enumerate(chunks):
+            tokens = tokenize(chunk)
+            doc_len[doc_id] = len(tokens)
+            for tok in tokens:
+                tf = postings.setdefault(tok, {})
+                tf[doc_id] = tf.get(doc_id, 0) + 1
+
+        terms = sorted(postings)
+        avgdl = float(doc_len.mean()) or 1.0
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        doc_ids: List[int] = []
+        weights: List[float] = []
+
+        for t_idx, term in enumerate(terms):
+            tf_map = postings[term]
+            df = len(tf_map)
+            idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc_id in sorted(tf_map):
+                tf = tf_map[doc_id]
+                norm = k1 * (1.0 - b + b * doc_len[doc_id] / avgdl)
+                doc_ids.append(doc_id)
+                weights.append(idf * tf * (k1 + 1.0) / (tf + norm))
+            indptr[t_idx + 1] = len(doc_ids)
+
+        term_blob, term_offsets = _pack_terms(terms)
+        return cls(
+            term_blob,
+            term_offsets,
+            indptr,
+            np.asarray(doc_ids, dtype=np.int32),
+            np.asarray(weights, dtype=np.float32),
+            n_docs,
+        )
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for tok in set(tokenize(query)):
+            t_idx = self.term_id(tok)
+            if t_idx is None:
+                continue
+            start, end = self.indptr[t_idx], self.indptr[t_idx + 1]
+            # chunk ids are unique within one posting list, so plain fancy-index add is safe
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+        return scores
+
+    def search(self, query: str, k: int) -> List[int]:
+        """Chunk ids of the top-k BM25 matches (only chunks sharing a term)."""
+        if not self.n_docs or k <= 0:
+            return []
+        scores = self.scores(query)
+        hits = np.flatnonzero(scores)
+        if hits.size > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        return hits[np.argsort(-scores[hits], kind="stable")].tolist()
+
+    # ---------- persistence ----------
+
+    def save(self, path: str) -> None:
+        np.savez(
+            path,
+            term_blob=np.frombuffer(self.term_blob, dtype=np.uint8),
+            term_offsets=self.term_offsets,
+            indptr=self.indptr,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            n_docs=np.asarray(self.n_docs),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path, allow_pickle=False) as data:
+            if "terms" in data.files:
+                # indexes saved with a fixed-width unicode term array
+                term_blob, term_offsets = _pack_terms(data["terms"].tolist())
+            else:
+                term_blob = data["term_blob"].tobytes()
+                term_offsets = data["term_offsets"]
+            return cls(
+                term_blob,
+                term_offsets,
+                data["indptr"],
+                data["doc_ids"],
+                data["weights"],
+                int(data["n_docs"]),
+            )
+
+
+def reciprocal_rank_fusion_scores(rankings: Iterable[Sequence[int]], k: int = 60) -> Dict[int, float]:
+    """Fused score of every id in several ranked id lists: sum 1 / (k + rank)."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return fused
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[int]], k: int = 60) -> List[int]:
+    """Fuse several ranked id lists: score(d) = sum 1 / (k + rank)."""
+    fused = reciprocal_rank_fusion_scores(rankings, k)
+    return sorted(fused, key=lambda d: fused[d], reverse=True)
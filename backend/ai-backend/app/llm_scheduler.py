@@ -0,0 +1,298 @@
+# app/llm_scheduler.py
+
+"""
+Priority-aware admission to Ollama, replacing the plain BoundedSemaphore.
+
+- Three classes: INTERACTIVE (student asks) > STEP (step generation) >
+  BACKGROUND (lesson planning). A free slot always goes to the highest
+  class with waiters.
+- Within a class, waiters are served round-robin per key (lesson / user),
+  so one big lesson cannot starve another.
+- Deferral: BACKGROUND may hold at most LLM_BACKGROUND_SLOTS slots.
+- Preemption: when an INTERACTIVE call is waiting and every slot is busy,
+  one running preemptible BACKGROUND call is asked to stop; its streaming
+  loop aborts and re-queues it (see ollama_client).
+- Admission control: when LLM_MAX_QUEUE non-background calls are already
+  waiting, new ones are shed with LLMOverloaded (-> 503 + Retry-After)
+  instead of piling up. Background planning is never shed.
+- Deadlines / cancellation: a ticket may carry a monotonic deadline and a
+  cancel Event; it leaves the queue (or aborts between stream chunks) once
+  either fires.
+- Queue wait time is recorded per class for /metrics/llm, together with
+  shed / expired / cancelled / aborted counts ("cancelled": the caller left
+  before any generation ran; "aborted": cancelled mid-generation), each
+  request counted once. A shared stream's producer stops when its last
+  subscriber leaves; that is counted apart as "upstream_abandoned", since
+  the subscribers already counted their own outcome.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+INTERACTIVE, STEP, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", STEP: "step", BACKGROUND: "background"}
+
+_tls = threading.local()
+
+
+class LLMPreempted(Exception):
+    """Raised inside a background call whose slot was taken for interactive work."""
+
+
+class LLMOverloaded(Exception):
+    """The admission queue is full; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"LLM queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMDeadlineExceeded(Exception):
+    """The request's deadline passed before the reply was complete."""
+
+
+class LLMCancelled(Exception):
+    """Nobody is waiting for the reply any more (e.g. the client disconnected)."""
+
+
+class Ticket:
+    def __init__(
+        self,
+        priority: int,
+        key: Optional[str],
+        preemptible: bool,
+        deadline: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+    ):
+        self.priority = priority
+        self.key = key or ""
+        self.preemptible = preemptible
+        self.deadline = deadline
+        self.cancel = cancel
+        self.granted = False
+        self.preempted = threading.Event()
+        self.enqueued = time.monotonic()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline (None = no deadline)."""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def check(self) -> None:
+        """Call between stream chunks; raises if the call should stop."""
+        if self.preempted.is_set():
+            raise LLMPreempted()
+        if self.cancel is not None and self.cancel.is_set():
+            raise LLMCancelled()
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise LLMDeadlineExceeded()
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        slots: int,
+        background_slots: Optional[int] = None,
+        preempt: bool = True,
+        max_queue: Optional[int] = None,
+    ):
+        self.slots = max(1, slots)
+        self.background_slots = min(self.slots, background_slots or self.slots)
+        self.preempt = preempt
+        self.max_queue = max_queue
+        self._cond = threading.Condition()
+        # per class: key -> FIFO of tickets; key order is the round-robin order
+        self._queues: List["OrderedDict[str, Deque[Ticket]]"] = [OrderedDict() for _ in PRIORITY_NAMES]
+        self._running: List[Ticket] = []
+        self._waits: Dict[int, Deque[float]] = {p: deque(maxlen=2000) for p in PRIORITY_NAMES}
+        self._served: Dict[int, int] = {p: 0 for p in PRIORITY_NAMES}
+        self._preemptions = 0
+        # durations of foreground calls, for the Retry-After estimate
+        self._service: Deque[float] = deque(maxlen=200)
+        self._events: Dict[str, int] = {
+            "shed": 0,
+            "expired": 0,
+            "cancelled": 0,
+            "aborted": 0,
+            "upstream_abandoned": 0,
+        }
+
+    # ---------- internal (call with self._cond held) ----------
+
+    def _running_in(self, priority: int) -> int:
+        return sum(1 for t in self._running if t.priority == priority)
+
+    def _next_ticket(self) -> Optional[Ticket]:
+        if len(self._running) >= self.slots:
+            return None
+        for priority, queue in enumerate(self._queues):
+            if not queue:
+                continue
+            if priority == BACKGROUND and self._running_in(BACKGROUND) >= self.background_slots:
+                return None
+            key, waiters = next(iter(queue.items()))
+            ticket = waiters.popleft()
+            if waiters:
+                queue.move_to_end(key)
+            else:
+                del queue[key]
+            return ticket
+        return None
+
+    def _dispatch(self) -> None:
+        granted = False
+        while True:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            ticket.granted = True
+            self._running.append(ticket)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _foreground_waiting(self) -> int:
+        return sum(len(q) for p in (INTERACTIVE, STEP) for q in self._queues[p].values())
+
+    def _retry_after(self) -> int:
+        """Seconds until the current foreground backlog should have drained."""
+        if not self._service:
+            return 5
+        per_call = sorted(self._service)[len(self._service) // 2]
+        backlog = self._foreground_waiting() + len(self._running)
+        return max(1, min(120, math.ceil(backlog / self.slots * per_call)))
+
+    def _dequeue(self, ticket: Ticket) -> None:
+        queue = self._queues[ticket.priority]
+        waiters = queue.get(ticket.key)
+        if waiters is not None and ticket in waiters:
+            waiters.remove(ticket)
+            if not waiters:
+                del queue[ticket.key]
+
+    def _maybe_preempt(self) -> None:
+        if not self.preempt or not self._queues[INTERACTIVE]:
+            return
+        if len(self._running) < self.slots:
+            return
+        if any(t.preempted.is_set() for t in self._running):
+            return  # one preemption already in flight
+        victims = [t for t in self._running if t.priority == BACKGROUND and t.preemptible]
+        if victims:
+            # the youngest background call has wasted the least generation
+            max(victims, key=lambda t: t.enqueued).preempted.set()
+            self._preemptions += 1
+
+    # ---------- public ----------
+
+    def record(self, event: str) -> None:
+        """Count a request outcome decided outside the scheduler (expired / cancelled)."""
+        with self._cond:
+            self._events[event] = self._events.get(event, 0) + 1
+
+    @contextmanager
+    def slot(
+        self,
+        priority: int = BACKGROUND,
+        key: Optional[str] = None,
+        preemptible: bool = True,
+        deadline: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+        upstream: bool = False,
+    ) -> Iterator[Ticket]:
+        """
+        Hold one Ollama slot. Raises LLMOverloaded when the foreground queue
+        is full, LLMDeadlineExceeded / LLMCancelled when the ticket's deadline
+        passes or its cancel Event is set while still queued.
+
+        upstream=True: `cancel` is a shared stream's "every subscriber left"
+        Event; the subscribers count their own outcome, so a cancel here is
+        only counted as upstream_abandoned.
+        """
+        cancelled = "upstream_abandoned" if upstream else "cancelled"
+        aborted = "upstream_abandoned" if upstream else "aborted"
+        ticket = Ticket(priority, key, preemptible and priority == BACKGROUND, deadline, cancel)
+        with self._cond:
+            if (
+                priority != BACKGROUND
+                and self.max_queue is not None
+                and self._foreground_waiting() >= self.max_queue
+            ):
+                self._events["shed"] += 1
+                raise LLMOverloaded(self._retry_after())
+
+            self._queues[priority].setdefault(ticket.key, deque()).append(ticket)
+            self._dispatch()
+            self._maybe_preempt()
+            while not ticket.granted:
+                try:
+                    ticket.check()
+                except (LLMCancelled, LLMDeadlineExceeded) as e:
+                    self._dequeue(ticket)
+                    # gave up before getting a slot: nothing was generated, so not "aborted"
+                    self._events[cancelled if isinstance(e, LLMCancelled) else "expired"] += 1
+                    raise
+                timeout = ticket.remaining()
+                if ticket.cancel is not None:
+                    # the cancel Event does not notify us; poll it
+                    timeout = 0.25 if timeout is None else min(timeout, 0.25)
+                self._cond.wait(timeout)
+            wait = time.monotonic() - ticket.enqueued
+            self._waits[priority].append(wait)
+            self._served[priority] += 1
+        _tls.last_wait = wait
+
+        started = time.monotonic()
+        try:
+            yield ticket
+        except LLMCancelled:
+            self.record(aborted)
+            raise
+        except LLMDeadlineExceeded:
+            self.record("expired")
+            raise
+        finally:
+            with self._cond:
+                self._running.remove(ticket)
+                if priority != BACKGROUND:
+                    self._service.append(time.monotonic() - started)
+                self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            out: Dict[str, Any] = {
+                "slots": self.slots,
+                "background_slots": self.background_slots,
+                "preemptions": self._preemptions,
+                "max_queue": self.max_queue,
+                **self._events,
+            }
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._waits[priority])
+                out[name] = {
+                    "waiting": sum(len(q) for q in self._queues[priority].values()),
+                    "running": self._running_in(priority),
+                    "served": self._served[priority],
+                    "wait_ms_p50": round(_percentile(waits, 0.50) * 1000, 1),
+                    "wait_ms_p95": round(_percentile(waits, 0.95) * 1000, 1),
+                    "wait_ms_max": round((waits[-1] if waits else 0.0) * 1000, 1),
+                }
+            return out
+
+
+def last_wait_seconds() -> float:
+    """Queue wait of the most recent slot acquired on this thread."""
+    return getattr(_tls, "last_wait", 0.0)
@@ -1,15 +1,41 @@
+import hashlib
 import json
 import re
-import time
 import threading
-from typing import Any, Optional, List, Dict
+import time
+from typing import Any, Callable, Iterator, Optional, List, Dict, Tuple
 
 import requests
-from app.config import OLLAMA_URL, MODEL_NAME
+from app.config import (
+    OLLAMA_URL,
+    MODEL_NAME,
+    MAX_PROMPT_CHARS,
+    OLLAMA_CONCURRENCY,
+    LLM_BACKGROUND_SLOTS,
+    LLM_PREEMPT_BACKGROUND,
+    LLM_MAX_QUEUE,
+)
+from app.llm_scheduler import (
+    BACKGROUND,
+    STEP,
+    LLMCancelled,
+    LLMDeadlineExceeded,
+    LLMOverloaded,
+    LLMPreempted,
+    LLMScheduler,
+)
+from app.singleflight import FlightCancelled, SingleFlight
 
-# limit concurrent calls
-_SEMAPHORE = threading.BoundedSemaphore(2)
-_MAX_PROMPT_CHARS = 9000
+# limit concurrent calls; interactive work is admitted before background planning
+_SCHEDULER = LLMScheduler(
+    OLLAMA_CONCURRENCY, LLM_BACKGROUND_SLOTS, LLM_PREEMPT_BACKGROUND, LLM_MAX_QUEUE
+)
+_MAX_PROMPT_CHARS = MAX_PROMPT_CHARS
+# a call preempted this often stops being preemptible, so it always finishes
+_MAX_PREEMPTIONS = 3
+# identical concurrent prompts share one generation
+_LLM_FLIGHTS = SingleFlight("llm")
+_LLM_STREAM_FLIGHTS = SingleFlight("llm_stream")
 
 
 def _trim_prompt(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
@@ -24,50 +50,300 @@ def _trim_prompt(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
     return messages
 
 
-def query_ollama(messages, timeout=120, stream=True, retries=1) -> str:
+def llm_scheduler_stats() -> Dict[str, Any]:
+    return _SCHEDULER.stats()
+
+
+def _prompt_key(payload: Dict[str, Any]) -> str:
+    """Coalescing key: model + format + messages with whitespace/case normalized."""
+    normalized = {
+        "model": payload["model"],
+        "format": payload.get("format"),
+        "stream": payload.get("stream"),
+        "messages": [
+            [m.get("role", ""), " ".join(m.get("content", "").split()).casefold()]
+            for m in payload["messages"]
+        ],
+    }
+    raw = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _scheduled(
+    call: Callable[[Any], Any],
+    priority: int,
+    key: Optional[str],
+    retries: int,
+    deadline: Optional[float] = None,
+    cancel: Optional[threading.Event] = None,
+    upstream: bool = False,
+):
+    """
+    Run call(ticket) inside a scheduler slot, retrying failures.
+    A preempted background call is re-queued without using up a retry;
+    shedding, deadlines and cancellation are never retried.
+    `upstream`: see LLMScheduler.slot.
+    """
+    attempt = 0
+    preemptions = 0
+    while True:
+        try:
+            with _SCHEDULER.slot(
+                priority,
+                key,
+                preemptible=preemptions < _MAX_PREEMPTIONS,
+                deadline=deadline,
+                cancel=cancel,
+                upstream=upstream,
+            ) as ticket:
+                return call(ticket)
+        except LLMPreempted:
+            preemptions += 1
+        except (LLMOverloaded, LLMDeadlineExceeded, LLMCancelled):
+            raise
+        except Exception:
+            attempt += 1
+            if attempt > retries:
+                raise
+            time.sleep(1.5)
+
+
+def _http_timeout(timeout: float, ticket) -> float:
+    """Per-read HTTP timeout, never past the ticket's deadline."""
+    remaining = ticket.remaining()
+    return timeout if remaining is None else max(min(timeout, remaining), 0.1)
+
+
+def query_ollama(
+    messages,
+    timeout=120,
+    stream=True,
+    retries=1,
+    format=None,
+    priority: int = STEP,
+    key: Optional[str] = None,
+    deadline: Optional[float] = None,
+) -> str:
+    """
+    Send a chat request to Ollama and return the full reply text.
+    `format` is passed through as Ollama's structured-output option:
+    either "json" or a JSON schema dict the reply must conform to.
+    `priority` / `key` (lesson or user) decide the order of admission.
+    `deadline` (time.monotonic) bounds queueing plus generation; coalesced
+    callers share the first caller's deadline.
+    """
     messages = _trim_prompt(messages)
     payload = {"model": MODEL_NAME, "messages": messages, "stream": stream}
-    
-    last_error = None
-
-    for attempt in range(retries + 1):
-        with _SEMAPHORE:
-            try:
-                response = requests.post(
-                    OLLAMA_URL, 
-                    json=payload, 
-                    timeout=timeout, 
-                    stream=stream
-                )
+    if format is not None:
+        payload["format"] = format
+
+    def call(ticket) -> str:
+        http_timeout = _http_timeout(timeout, ticket)
+        with requests.post(OLLAMA_URL, json=payload, timeout=http_timeout, stream=stream) as response:
+            response.raise_for_status()
+
+            if not stream:
+                data = response.json()
+                return data.get("message", {}).get("content", "")
+
+            # streaming handling
+            return "".join(_iter_stream_content(response, ticket))
+
+    return _LLM_FLIGHTS.do(
+        _prompt_key(payload), lambda: _scheduled(call, priority, key, retries, deadline=deadline)
+    )
+
+
+def stream_ollama(
+    messages,
+    timeout=120,
+    priority: int = STEP,
+    key: Optional[str] = None,
+    deadline: Optional[float] = None,
+    cancel: Optional[threading.Event] = None,
+) -> Iterator[str]:
+    """
+    Yield reply chunks as Ollama produces them. Identical concurrent prompts
+    share one generation whose chunks are fanned out to every caller.
+    Not retried: chunks may already have been delivered.
+
+    Each caller has its own `deadline` (time.monotonic; raises
+    LLMDeadlineExceeded) and `cancel` Event (set it when the client goes
+    away; raises LLMCancelled). Once every caller of a shared generation
+    has left, the upstream request is closed and Ollama stops generating.
+    """
+    messages = _trim_prompt(messages)
+    payload = {"model": MODEL_NAME, "messages": messages, "stream": True}
+
+    def produce(emit, abandoned: threading.Event) -> None:
+        def call(ticket) -> None:
+            with requests.post(OLLAMA_URL, json=payload, timeout=timeout, stream=True) as response:
                 response.raise_for_status()
+                for chunk in _iter_stream_content(response, ticket):
+                    emit(chunk)
+
+        # the shared generation has no deadline of its own: it runs while
+        # anyone is still listening (each subscriber enforces its deadline)
+        # (subscribers' own deadline / cancel outcomes are counted in _counted)
+        _scheduled(call, priority, key, retries=0, cancel=abandoned, upstream=True)
+
+    subscription = _LLM_STREAM_FLIGHTS.stream(_prompt_key(payload), produce, deadline, cancel)
+    return _counted(subscription)
+
+
+def _counted(subscription) -> Iterator[str]:
+    """
+    Map a subscription's deadline / cancel outcome to LLM errors and count
+    them; the only place a streamed request's outcome is counted.
+    """
+    generating = False
+    try:
+        for chunk in subscription:
+            generating = True
+            yield chunk
+    except TimeoutError:
+        _SCHEDULER.record("expired")
+        raise LLMDeadlineExceeded()
+    except FlightCancelled:
+        _SCHEDULER.record("aborted" if generating else "cancelled")
+        raise LLMCancelled()
+    finally:
+        subscription.close()
+
+
+def _iter_stream_content(response, ticket=None) -> Iterator[str]:
+    """
+    Yield content pieces from an Ollama NDJSON chat stream until `done`.
+    Raises LLMPreempted between chunks if the scheduler reclaimed the slot.
+    """
+    for line in response.iter_lines():
+        if ticket is not None:
+            ticket.check()
+        if not line:
+            continue
+        try:
+            obj = json.loads(line.decode("utf-8"))
+        except:
+            continue
+        chunk = obj.get("message", {}).get("content", "")
+        if chunk:
+            yield chunk
+        if obj.get("done"):
+            break
+
+
+# ---------- EARLY-STOP JSON STREAMING ----------
+
+class JsonStreamParser:
+    """
+    Incremental scanner that spots the first complete top-level JSON
+    array/object in a growing text stream.
+
+    Tracks bracket depth and string/escape state, so braces inside string
+    values don't confuse it. A balanced candidate that fails to parse (or is
+    is rejected by `validate`) is discarded and scanning resumes just after
+    its opening bracket, so prose like "see [1]" before the real payload is
+    skipped.
+    """
+
+    def __init__(self, validate: Optional[Callable[[Any], bool]] = None):
+        self.validate = validate
+        self.text = ""
+        self.value: Any = None
+        self.done = False
+        self._pos = 0
+        self._start = -1
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    def feed(self, chunk: str) -> bool:
+        """Append a chunk; returns True once a complete value was parsed."""
+        if self.done:
+            return True
+        self.text += chunk
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if self._start == -1:
+                if c in "{[":
+                    self._start, self._depth = i, 1
+                    self._in_str = self._esc = False
+            elif self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+            elif c == '"':
+                self._in_str = True
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    start, self._start = self._start, -1
+                    if self._accept(text[start : i + 1]):
+                        self._pos = i + 1
+                        return True
+                    i = start
+            i += 1
+        self._pos = i
+        return False
+
+    def _accept(self, candidate: str) -> bool:
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            return False
+        if self.validate is not None and not self.validate(value):
+            return False
+        self.value, self.done = value, True
+        return True
+
+
+def query_ollama_json(
+    messages,
+    timeout=120,
+    retries=1,
+    format=None,
+    validate: Optional[Callable[[Any], bool]] = None,
+    priority: int = BACKGROUND,
+    key: Optional[str] = None,
+) -> Tuple[Any, str]:
+    """
+    Stream a chat reply and stop as soon as a complete top-level JSON value
+    has been emitted, closing the connection so Ollama stops generating.
+    `validate` rejects values of the wrong shape (e.g. a stray "[1]").
+
+    Returns (parsed_value_or_None, raw_text_received). If the stream ends
+    without a complete value, falls back to extract_json_from_model_output
+    on the full text (fenced block / brace slicing).
+    """
+    messages = _trim_prompt(messages)
+    payload = {"model": MODEL_NAME, "messages": messages, "stream": True}
+    if format is not None:
+        payload["format"] = format
+
+    def call(ticket) -> Tuple[Any, str]:
+        parser = JsonStreamParser(validate=validate)
+        with requests.post(OLLAMA_URL, json=payload, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            for chunk in _iter_stream_content(response, ticket):
+                if parser.feed(chunk):
+                    # leaving the `with` closes the socket -> Ollama aborts
+                    return parser.value, parser.text
+
+        data = extract_json_from_model_output(parser.text)
+        if validate is not None and data is not None and not validate(data):
+            data = None
+        return data, parser.text
 
-                if not stream:
-                    data = response.json()
-                    return data.get("message", {}).get("content", "")
-
-                # streaming handling
-                final = []
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    try:
-                        obj = json.loads(line.decode("utf-8"))
-                        chunk = obj.get("message", {}).get("content", "")
-                        if chunk:
-                            final.append(chunk)
-                        if obj.get("done"):
-                            break
-                    except:
-                        continue
-
-                return "".join(final)
-
-            except Exception as e:
-                last_error = e
-                if attempt < retries:
-                    time.sleep(1.5)
-    
-    raise last_error
+    # validate is part of the contract, so it joins the coalescing key
+    flight_key = (_prompt_key(payload), getattr(validate, "__name__", None))
+    return _LLM_FLIGHTS.do(flight_key, lambda: _scheduled(call, priority, key, retries))
 
 
 def extract_json_from_model_output(raw_output: str):
@@ -2,96 +2,101 @@
 
 import json
 import os
-import re
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-from app.config import BASE_LESSON_DIR
+from app.chunker import Span, chunk_spans, hf_token_offsets
+from app.config import (
+    BASE_LESSON_DIR,
+    CHUNK_OVERLAP_TOKENS,
+    CHUNK_TOKENS,
+    EMBED_SERVICE,
+    HYBRID_SEARCH,
+    RRF_K,
+)
+from app.embedders import LEGACY_SIGNATURE, check_signature, load_embedder
+from app.lexical import BM25Index, reciprocal_rank_fusion_scores
 
 _EMBED_MODEL = None
 
 
-def get_embedder() -> SentenceTransformer:
+def get_embedder():
+    """
+    Process-wide embedder (backend from EMBED_BACKEND). With EMBED_SERVICE=1
+    this is a client of the shared embedding process (app.embed_service)
+    instead of a local model.
+    """
     global _EMBED_MODEL
     if _EMBED_MODEL is None:
-        _EMBED_MODEL = SentenceTransformer("all-MiniLM-L6-v2")
-    return _EMBED_MODEL
+        if EMBED_SERVICE:
+            from app.embed_service import RemoteEmbedder
 
+            _EMBED_MODEL = RemoteEmbedder()
+        else:
+            _EMBED_MODEL = load_embedder()
+    return _EMBED_MODEL
 
-def _split_into_paragraphs(text: str) -> List[str]:
-    # split on blank lines, collapse internal newlines
-    paras = re.split(r"\n\s*\n+", text)
-    cleaned = []
-    for p in paras:
-        p = p.strip()
-        if not p:
-            continue
-        # normalize multiple spaces / newlines
-        p = re.sub(r"[ \t]+", " ", p)
-        cleaned.append(p)
-    return cleaned
 
+def embedder_signature() -> Dict[str, Any]:
+    """{model, backend} of the running embedder; vectors are only comparable within one."""
+    return dict(get_embedder().signature)
 
-def chunk_text(text: str, chunk_size: int = 800, overlap: int = 200) -> List[str]:
-    """
-    Semantic-ish paragraph based chunking.
 
-    – First split into paragraphs.
-    – Greedily pack paragraphs into ~chunk_size chars.
-    – Keep `overlap` chars from the end of previous chunk as prefix
-      to the next, to preserve context.
-    """
-    paragraphs = _split_into_paragraphs(text)
-    if not paragraphs:
-        return []
+def _embedder_offsets():
+    return hf_token_offsets(get_embedder().tokenizer)
 
-    chunks: List[str] = []
-    current = ""
 
-    for para in paragraphs:
-        if not current:
-            current = para
-            continue
+def chunk_text_spans(
+    text: str,
+    max_tokens: Optional[int] = None,
+    overlap_tokens: Optional[int] = None,
+) -> List[Span]:
+    """
+    Paragraph-packed chunk spans sized in embedder tokens.
+    max_tokens defaults to CHUNK_TOKENS, capped so that a chunk plus the
+    special tokens fits the embedder window (no silent truncation).
+    """
+    if max_tokens is None:
+        window = get_embedder().max_seq_length or CHUNK_TOKENS + 2
+        max_tokens = min(CHUNK_TOKENS, window - 2)
+    if overlap_tokens is None:
+        overlap_tokens = CHUNK_OVERLAP_TOKENS
+    return chunk_spans(text, max_tokens, overlap_tokens, _embedder_offsets())
 
-        if len(current) + 2 + len(para) <= chunk_size:
-            current = f"{current}\n\n{para}"
-        else:
-            chunks.append(current)
 
-            # overlap: keep tail of previous chunk
-            if overlap > 0 and len(current) > overlap:
-                tail = current[-overlap:]
-                current = f"{tail}\n\n{para}"
-            else:
-                current = para
+def chunk_text(
+    text: str,
+    max_tokens: Optional[int] = None,
+    overlap_tokens: Optional[int] = None,
+) -> List[str]:
+    """Same as chunk_text_spans, but returns the chunk strings."""
+    return [text[s:e] for s, e in chunk_text_spans(text, max_tokens, overlap_tokens)]
 
-    if current:
-        chunks.append(current)
 
-    return chunks
+def build_flat_index(vectors: np.ndarray) -> faiss.Index:
+    """Inner-product FAISS index over L2-normalized vectors (normalized in place)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    dim = vectors.shape[1]
+    index = faiss.IndexFlatIP(dim)
+    faiss.normalize_L2(vectors)
+    index.add(vectors)
+    return index
 
 
-def build_rag_index(lesson_id: str, full_text: str) -> None:
+def save_rag_index(
+    lesson_id: str,
+    index: faiss.Index,
+    chunks: List[str],
+    spans: List[Span],
+) -> None:
     """
-    Create chunks, embeddings, and FAISS index for a lesson.
-    Saves into lessons/<lesson_id>/{index.faiss,chunks.json}
+    Saves into lessons/<lesson_id>/{index.faiss,chunks.json,spans.json,bm25.npz,embedding.json}
     """
     lesson_dir = os.path.join(BASE_LESSON_DIR, lesson_id)
     os.makedirs(lesson_dir, exist_ok=True)
 
-    chunks = chunk_text(full_text)
-    embedder = get_embedder()
-    vectors = embedder.encode(chunks, show_progress_bar=False)
-    vectors = np.asarray(vectors, dtype=np.float32)
-
-    dim = vectors.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    faiss.normalize_L2(vectors)
-    index.add(vectors)
-
     index_path = os.path.join(lesson_dir, "index.faiss")
     faiss.write_index(index, index_path)
 
@@ -99,9 +104,34 @@ def build_rag_index(lesson_id: str, full_text: str) -> None:
     with open(chunks_path, "w", encoding="utf-8") as f:
         json.dump(chunks, f, ensure_ascii=False, indent=2)
 
+    # character offsets of each chunk in the extracted text
+    with open(os.path.join(lesson_dir, "spans.json"), "w", encoding="utf-8") as f:
+        json.dump(spans, f)
+
+    BM25Index.build(chunks).save(os.path.join(lesson_dir, "bm25.npz"))
+
+    # which embedder built the vectors, so a lesson is never searched with another
+    signature = {**embedder_signature(), "dim": index.d}
+    with open(os.path.join(lesson_dir, "embedding.json"), "w", encoding="utf-8") as f:
+        json.dump(signature, f, indent=2)
+
     print(f"✅ RAG index built for lesson '{lesson_id}' with {len(chunks)} chunks.")
 
 
+def build_rag_index(lesson_id: str, full_text: str) -> Tuple[faiss.Index, List[str], List[Span]]:
+    """
+    Create chunks, embeddings, FAISS index and BM25 index for a lesson and
+    save them. Returns (index, chunks, spans) so planning can reuse them.
+    """
+    spans = chunk_text_spans(full_text)
+    chunks = [full_text[s:e] for s, e in spans]
+    embedder = get_embedder()
+    vectors = embedder.encode(chunks, show_progress_bar=False)
+    index = build_flat_index(vectors)
+    save_rag_index(lesson_id, index, chunks, spans)
+    return index, chunks, spans
+
+
 def load_rag_index(lesson_id: str) -> Tuple[faiss.Index, List[str]]:
     lesson_dir = os.path.join(BASE_LESSON_DIR, lesson_id)
     index_path = os.path.join(lesson_dir, "index.faiss")
@@ -110,6 +140,8 @@ def load_rag_index(lesson_id: str) -> Tuple[faiss.Index, List[str]]:
     if not (os.path.exists(index_path) and os.path.exists(chunks_path)):
         raise FileNotFoundError(f"No RAG data found for lesson '{lesson_id}'")
 
+    check_signature(lesson_id, load_embedding_signature(lesson_id), embedder_signature())
+
     index = faiss.read_index(index_path)
     with open(chunks_path, "r", encoding="utf-8") as f:
         chunks = json.load(f)
@@ -117,15 +149,130 @@ def load_rag_index(lesson_id: str) -> Tuple[faiss.Index, List[str]]:
     return index, chunks
 
 
-def rag_search(index, chunks: List[str], query: str, k: int = 4) -> List[str]:
-    """Return top-k relevant chunks for a query."""
-    if not chunks:
-        return []
+def load_embedding_signature(lesson_id: str) -> Dict[str, Any]:
+    """
+    Embedder a lesson was built with. Lessons from before embedding.json
+    were all built with the original torch model.
+    """
+    path = os.path.join(BASE_LESSON_DIR, lesson_id, "embedding.json")
+    if not os.path.exists(path):
+        return dict(LEGACY_SIGNATURE)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_rag_spans(lesson_id: str) -> Optional[List[Span]]:
+    """Chunk spans for a lesson, or None for lessons built before spans.json."""
+    path = os.path.join(BASE_LESSON_DIR, lesson_id, "spans.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return [tuple(span) for span in json.load(f)]
 
+
+def load_lexical_index(lesson_id: str) -> Optional[BM25Index]:
+    """BM25 index for a lesson, or None for lessons built before it existed."""
+    path = os.path.join(BASE_LESSON_DIR, lesson_id, "bm25.npz")
+    if not os.path.exists(path):
+        return None
+    return BM25Index.load(path)
+
+
+def encode_query(query: str) -> np.ndarray:
+    """(1, dim) L2-normalized query vector."""
     embedder = get_embedder()
     q_vec = embedder.encode([query], show_progress_bar=False)
     q_vec = np.asarray(q_vec, dtype=np.float32)
     faiss.normalize_L2(q_vec)
+    return q_vec
+
+
+def scoped_dense_search(index, scope: Sequence[int], q_vec: np.ndarray) -> Tuple[List[int], np.ndarray]:
+    """
+    Dense ranking restricted to the chunk ids in `scope` (e.g. one
+    subtopic's chunks): a small sub-index of the stored vectors, scanned
+    instead of the whole lesson. Returns (ids, cosine scores), best first.
+    """
+    ids = np.array(sorted({int(i) for i in scope if 0 <= int(i) < index.ntotal}), dtype=np.int64)
+    if not len(ids):
+        return [], np.zeros(0, dtype=np.float32)
+    scores = index.reconstruct_batch(ids) @ q_vec[0]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order].tolist(), scores[order]
+
+
+def search_ids(
+    index,
+    chunks: List[str],
+    query: str,
+    k: int,
+    lexical: Optional[BM25Index] = None,
+    q_vec: Optional[np.ndarray] = None,
+    scope: Optional[Sequence[int]] = None,
+) -> List[int]:
+    """
+    Chunk ids of the top-k matches for a query.
+    Dense only, unless a BM25 index is given (and HYBRID_SEARCH is on):
+    then both rankings are fused with reciprocal-rank fusion.
+    Pass `q_vec` (from encode_query) to avoid encoding the query twice,
+    and `scope` to search only those chunk ids.
+    """
+    return search_scored(index, chunks, query, k, lexical, q_vec, scope)[0]
+
+
+def search_scored(
+    index,
+    chunks: List[str],
+    query: str,
+    k: int,
+    lexical: Optional[BM25Index] = None,
+    q_vec: Optional[np.ndarray] = None,
+    scope: Optional[Sequence[int]] = None,
+) -> Tuple[List[int], np.ndarray]:
+    """
+    Same as search_ids, plus each hit's score, best first: the cosine for
+    dense-only search, the fused RRF score for hybrid search.
+    """
+    if not chunks:
+        return [], np.zeros(0, dtype=np.float32)
+
     k = min(k, len(chunks))
-    D, I = index.search(q_vec, k)
-    return [chunks[i] for i in I[0]]
+    use_lexical = lexical is not None and HYBRID_SEARCH
+    depth = min(max(k * 3, 20), len(chunks)) if use_lexical else k
+
+    if q_vec is None:
+        q_vec = encode_query(query)
+
+    if scope is not None:
+        dense, cosines = scoped_dense_search(index, scope, q_vec)
+        if not use_lexical:
+            return dense[:k], cosines[:k]
+        bm25 = lexical.scores(query)
+        lex = [i for i in sorted(dense, key=lambda i: -bm25[i]) if bm25[i] > 0]
+        return _top_fused([dense, lex], k)
+
+    D, I = index.search(q_vec, depth)
+    hits = I[0] >= 0
+    dense = [int(i) for i in I[0][hits]]
+
+    if not use_lexical:
+        return dense[:k], D[0][hits][:k]
+
+    return _top_fused([dense, lexical.search(query, depth)], k)
+
+
+def _top_fused(rankings: List[List[int]], k: int) -> Tuple[List[int], np.ndarray]:
+    fused = reciprocal_rank_fusion_scores(rankings, k=RRF_K)
+    ids = sorted(fused, key=lambda d: fused[d], reverse=True)[:k]
+    return ids, np.array([fused[i] for i in ids], dtype=np.float32)
+
+
+def rag_search(
+    index,
+    chunks: List[str],
+    query: str,
+    k: int = 4,
+    lexical: Optional[BM25Index] = None,
+) -> List[str]:
+    """Return top-k relevant chunks for a query."""
+    return [chunks[i] for i in search_ids(index, chunks, query, k, lexical)]
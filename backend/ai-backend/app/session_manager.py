@@ -1,85 +1,212 @@
-from app.lesson_plan import load_lesson_plan
-from app.rag import load_rag_index, rag_search
-from app.ollama_client import query_ollama
+from app.lesson_plan import load_lesson_plan, load_topic_chunks
+from app.config import ASK_CONTEXT_CHARS, ASK_SCOPE_MIN_SCORE
+from app.context_pack import pack_context
+from app.rag import (
+    encode_query,
+    load_rag_index,
+    load_lexical_index,
+    load_rag_spans,
+    scoped_dense_search,
+)
+from app.ollama_client import stream_ollama
+from app.llm_scheduler import INTERACTIVE
+from app.singleflight import SingleFlight
 from app.tutor import build_qa_messages
+from app.dialogue_memory import DialogueMemory
+from app.speech_formatter import (
+    END_OF_LESSON,
+    iter_sentences,
+    load_lesson_speech,
+    render_step,
+    sentence_ssml,
+    step_text,
+)
 
 _sessions = {}
 
-def start_session(user_id: str, lesson_id: str):
+# a class starting together loads each lesson's artifacts once, not once per student
+_ARTIFACT_FLIGHTS = SingleFlight("lesson_artifacts")
+
+def _load_lesson_artifacts(lesson_id: str):
     plan = load_lesson_plan(lesson_id)
     index, chunks = load_rag_index(lesson_id)
+    grounding = load_topic_chunks(lesson_id)
+    if grounding and grounding.get("chunk_count") != len(chunks):
+        grounding = None  # index rebuilt since planning; ids no longer line up
+    return {
+        "plan": plan,
+        "index": index,
+        "chunks": chunks,
+        "grounding": grounding,
+        "lexical": load_lexical_index(lesson_id),
+        "spans": load_rag_spans(lesson_id),
+        "speech": load_lesson_speech(lesson_id),
+    }
+
+def start_session(user_id: str, lesson_id: str):
+    # shared, read-only artifacts; per-session state is only the position
+    artifacts = _ARTIFACT_FLIGHTS.do(lesson_id, lambda: _load_lesson_artifacts(lesson_id))
 
     _sessions[user_id] = {
         "lesson_id": lesson_id,
-        "plan": plan,
         "topic": 0,
         "sub": 0,
         "micro": 0,
-        "index": index,
-        "chunks": chunks,
-        "started": False
+        "memory": DialogueMemory(user_id),
+        **artifacts,
     }
 
     return {"session_id": user_id, "content": current_step(user_id)}
 
 def current_step(session_id: str):
     s = _sessions[session_id]
-    topic = s["plan"]["topics"][s["topic"]]
-    subtopic = topic["subtopics"][s["sub"]]
-    micro = subtopic["micro_sections"][s["micro"]]
+    return step_text(s["plan"], s["topic"], s["sub"], s["micro"])
 
-    # First time the session is started
-    if not s["started"]:
-        s["started"] = True
-        opening = f"Let's begin the lesson titled: {s['plan']['title']}.\n"
-        opening += f"Our first topic is: {topic['title']}.\n"
-        opening += f"We'll start with the subtopic: {subtopic['title']}.\n\n"
-        opening += micro
-        return opening
+def _advance(s) -> bool:
+    """Move to the next micro-section; False once the lesson is over."""
+    topics = s["plan"]["topics"]
+    if s["topic"] >= len(topics):
+        return False
 
-    # If micro-index > 0, we're continuing the same subtopic
-    return micro
+    s["micro"] += 1
+    while s["topic"] < len(topics):
+        subtopics = topics[s["topic"]]["subtopics"]
+        if s["sub"] < len(subtopics):
+            if s["micro"] < len(subtopics[s["sub"]]["micro_sections"]):
+                return True
+            # Move to next subtopic
+            s["sub"] += 1
+            s["micro"] = 0
+            continue
+        # Move to next topic
+        s["topic"] += 1
+        s["sub"] = 0
+        s["micro"] = 0
+    return False
 
 def next_step(session_id: str):
     s = _sessions[session_id]
-    plan = s["plan"]
-
-    s["micro"] += 1
-    topic = plan["topics"][s["topic"]]
-    subtopic = topic["subtopics"][s["sub"]]
-
-    # Still inside same subtopic
-    if s["micro"] < len(subtopic["micro_sections"]):
-        return {"content": f"Continuing...\n{current_step(session_id)}"}
-
-    # Move to next subtopic
-    s["sub"] += 1
-    s["micro"] = 0
-
-    if s["sub"] < len(topic["subtopics"]):
-        new_sub = topic["subtopics"][s["sub"]]
-        return {"content": f"Moving on to a new subtopic: {new_sub['title']}.\n\n{current_step(session_id)}"}
-
-    # Move to next topic
-    s["topic"] += 1
-    s["sub"] = 0
-    s["micro"] = 0
-
-    if s["topic"] < len(plan["topics"]):
-        new_topic = plan["topics"][s["topic"]]
-        return {"content": f"Great progress so far.\nNow we will move into the next major topic: {new_topic['title']}.\n\n{current_step(session_id)}"}
-
-    # End of lesson
-    return {"content": "You've completed the entire lesson. Great work."}
-
-def ask_question(session_id: str, question: str):
+    if not _advance(s):
+        # End of lesson
+        return {"content": END_OF_LESSON}
+    return {"content": current_step(session_id)}
+
+def _current_speech(s):
+    """Precomputed text + SSML for the current step (rendered on the fly for old lessons)."""
+    speech = s.get("speech")
+    if s["topic"] >= len(s["plan"]["topics"]):
+        return speech["end"] if speech else render_step(END_OF_LESSON)
+    if speech:
+        return speech["steps"][s["topic"]][s["sub"]][s["micro"]]
+    return render_step(step_text(s["plan"], s["topic"], s["sub"], s["micro"]))
+
+def next_step_speech(session_id: str):
+    s = _sessions[session_id]
+    _advance(s)
+    step = _current_speech(s)
+    return {"content": step["text"], "ssml": step["ssml"]}
+
+def iter_next_step_sentences(session_id: str):
+    """
+    Advance and yield the new step sentence by sentence, so TTS can start
+    speaking the first sentence before the rest is sent.
+    """
     s = _sessions[session_id]
-    context = rag_search(s["index"], s["chunks"], question)
+    _advance(s)
+    speech = s.get("speech")
+    if speech:
+        yield from _current_speech(s)["sentences"]
+        return
+
+    if s["topic"] >= len(s["plan"]["topics"]):
+        text = END_OF_LESSON
+    else:
+        text = step_text(s["plan"], s["topic"], s["sub"], s["micro"])
+    for sentence in iter_sentences(text):
+        yield {"text": sentence, "ssml": sentence_ssml(sentence)}
+
+def _question_scope(s, q_vec):
+    """
+    (chunk ids, level) to answer from: the current subtopic's chunks, else
+    the current topic's, else (None, "lesson") when neither has a chunk
+    scoring at least ASK_SCOPE_MIN_SCORE.
+    """
+    grounding = s.get("grounding")
+    if not grounding or s["topic"] >= len(grounding["topics"]):
+        return None, "lesson"
+
+    topic = grounding["topics"][s["topic"]]
+    levels = []
+    if s["sub"] < len(topic["subtopics"]):
+        levels.append((topic["subtopics"][s["sub"]], "subtopic"))
+    levels.append((topic["chunk_ids"], "topic"))
+
+    for ids, level in levels:
+        _, scores = scoped_dense_search(s["index"], ids, q_vec)
+        if len(scores) and scores[0] >= ASK_SCOPE_MIN_SCORE:
+            return ids, level
+    return None, "lesson"
+
+def _qa_messages(s, question: str):
+    q_vec = encode_query(question)
+    scope, level = _question_scope(s, q_vec)
+    passages, stats = pack_context(
+        s["index"],
+        s["chunks"],
+        question,
+        ASK_CONTEXT_CHARS,
+        lexical=s.get("lexical"),
+        spans=s.get("spans"),
+        scope=scope,
+        q_vec=q_vec,
+    )
+    stats["scope"] = level
+    context = "\n\n".join(passages)
 
     topic = s["plan"]["topics"][s["topic"]]
     sub = topic["subtopics"][s["sub"]]
 
-    messages = build_qa_messages(question, topic["title"], sub["title"], sub["micro_sections"], context)
-    reply = query_ollama(messages)
-    
-    return {"answer": reply}
+    messages = build_qa_messages(
+        question,
+        topic["title"],
+        sub["title"],
+        sub["micro_sections"],
+        context,
+        history=s["memory"].messages(),
+    )
+    return messages, stats
+
+def ask_question(session_id: str, question: str, deadline=None, cancel=None):
+    """
+    Full answer. `deadline` (time.monotonic) and `cancel` (threading.Event,
+    set on client disconnect) stop the wait and, if nobody else shares the
+    generation, the generation itself.
+    """
+    s = _sessions[session_id]
+    messages, stats = _qa_messages(s, question)
+    # consumed from the shared stream so a disconnect can cancel it mid-generation
+    reply = "".join(
+        stream_ollama(messages, priority=INTERACTIVE, key=session_id, deadline=deadline, cancel=cancel)
+    )
+    s["memory"].add(question, reply)
+
+    return {
+        "answer": reply,
+        "prompt_tokens_saved": stats["tokens_saved"],
+        "context_scope": stats["scope"],
+    }
+
+def ask_question_stream(session_id: str, question: str, deadline=None, cancel=None):
+    """Answer chunks as they are generated (shared with identical concurrent asks)."""
+    s = _sessions[session_id]
+    messages, _ = _qa_messages(s, question)
+    chunks = stream_ollama(messages, priority=INTERACTIVE, key=session_id, deadline=deadline, cancel=cancel)
+    return _remembered(s, question, chunks)
+
+def _remembered(s, question: str, chunks):
+    """Pass chunks through; a fully delivered answer becomes a memory turn."""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    s["memory"].add(question, "".join(parts))
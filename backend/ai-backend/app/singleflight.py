@@ -0,0 +1,212 @@
+# app/singleflight.py
+
+"""
+Single-flight coalescing: concurrent callers asking for the same key share
+one in-flight computation instead of each running their own.
+
+    flights = SingleFlight("lesson_artifacts")
+    artifacts = flights.do(lesson_id, lambda: load_everything(lesson_id))
+
+For streamed results, stream() runs the producer once in a background
+thread and fans every chunk out to all subscribers; a subscriber that joins
+late first replays the chunks already emitted. Each subscriber may have its
+own deadline and cancel Event; when the last one leaves before the stream
+is finished, the producer's `abandoned` Event is set so it can stop early.
+
+Nothing is cached: once a flight finishes, the next call starts a new one.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+_groups: List["SingleFlight"] = []
+
+
+class FlightCancelled(Exception):
+    """The subscriber's cancel Event was set while it waited for chunks."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _Stream:
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.cond = threading.Condition()
+        self.subscribers = 0
+        self.abandoned = threading.Event()
+
+    def emit(self, chunk: Any) -> None:
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self.cond:
+            self.finished = True
+            self.error = error
+            self.cond.notify_all()
+
+
+class _Subscription:
+    """
+    Iterator over one flight's chunks. Raises TimeoutError past `deadline`
+    (time.monotonic) and FlightCancelled once `cancel` is set; close() leaves
+    the flight early.
+    """
+
+    def __init__(
+        self,
+        flight: _Stream,
+        deadline: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+    ):
+        self.flight = flight
+        self.deadline = deadline
+        self.cancel = cancel
+        self.closed = False
+        self._i = 0
+        flight.subscribers += 1  # caller holds the group lock
+
+    def __iter__(self) -> "_Subscription":
+        return self
+
+    def __next__(self) -> Any:
+        flight = self.flight
+        with flight.cond:
+            while True:
+                if self.closed:
+                    raise StopIteration
+                if self._i < len(flight.chunks):
+                    self._i += 1
+                    return flight.chunks[self._i - 1]
+                if flight.finished:
+                    self._leave()
+                    if flight.error is not None:
+                        raise flight.error
+                    raise StopIteration
+                if self.cancel is not None and self.cancel.is_set():
+                    self._leave()
+                    raise FlightCancelled()
+                timeout = None
+                if self.deadline is not None:
+                    timeout = self.deadline - time.monotonic()
+                    if timeout <= 0:
+                        self._leave()
+                        raise TimeoutError("deadline passed while waiting for the stream")
+                if self.cancel is not None:
+                    # the cancel Event does not notify the condition; poll it
+                    timeout = 0.25 if timeout is None else min(timeout, 0.25)
+                flight.cond.wait(timeout)
+
+    def close(self) -> None:
+        with self.flight.cond:
+            self._leave()
+
+    def _leave(self) -> None:
+        # flight.cond held
+        if self.closed:
+            return
+        self.closed = True
+        self.flight.subscribers -= 1
+        if self.flight.subscribers <= 0 and not self.flight.finished:
+            self.flight.abandoned.set()
+
+    def __del__(self):
+        if not self.closed:
+            self.close()
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._streams: Dict[Hashable, _Stream] = {}
+        self.calls = 0
+        self.coalesced = 0
+        _groups.append(self)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Run fn() once for all concurrent callers with the same key."""
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stream(
+        self,
+        key: Hashable,
+        produce: Callable[[Callable[[Any], None], threading.Event], None],
+        deadline: Optional[float] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> _Subscription:
+        """
+        Iterate the chunks of produce(emit, abandoned), started once per key
+        and shared by every concurrent subscriber. `abandoned` is set once
+        every subscriber has left, so the producer can stop.
+        """
+        with self._lock:
+            self.calls += 1
+            flight = self._streams.get(key)
+            if flight is None or flight.abandoned.is_set():
+                # an abandoned flight is winding down; don't join it
+                flight = self._streams[key] = _Stream()
+                threading.Thread(target=self._run_stream, args=(key, flight, produce), daemon=True).start()
+            else:
+                self.coalesced += 1
+            with flight.cond:
+                return _Subscription(flight, deadline, cancel)
+
+    def _run_stream(self, key: Hashable, flight: _Stream, produce) -> None:
+        error: Optional[BaseException] = None
+        try:
+            produce(flight.emit, flight.abandoned)
+        except BaseException as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+            flight.finish(error)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "coalesce_rate": round(self.coalesced / self.calls, 3) if self.calls else 0.0,
+                "in_flight": len(self._calls) + len(self._streams),
+            }
+
+
+def singleflight_stats() -> Dict[str, Any]:
+    return {group.name: group.stats() for group in _groups}
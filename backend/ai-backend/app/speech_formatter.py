@@ -1,26 +1,162 @@
-def format_script(section, micro_index, total_micro):
+# app/speech_formatter.py
+
+"""
+Speech-friendly rendering of lesson steps.
+
+step_text() is the single source of the tutor's transition phrasing, used by
+the session manager for plain text and here for SSML. SSML for every
+micro-section is rendered once when a lesson is saved (speech.json next to
+plan.json), so the talking buddy gets TTS-ready markup with each step.
+"""
+
+import json
+import os
+import re
+from typing import Any, Dict, Iterator, List, Optional
+from xml.sax.saxutils import escape
+
+from app.config import BASE_LESSON_DIR
+
+END_OF_LESSON = "You've completed the entire lesson. Great work."
+
+_SENTENCE_BREAK = "<break time='500ms'/>"
+_PARAGRAPH_BREAK = "<break time='800ms'/>"
+
+# words whose trailing period does not end a sentence
+_ABBREVIATIONS = {
+    "e.g.", "i.e.", "etc.", "vs.", "approx.", "fig.", "figs.", "eq.", "no.",
+    "dr.", "mr.", "mrs.", "ms.", "prof.", "st.", "jr.", "sr.", "ch.", "sec.",
+    "vol.", "p.", "pp.", "cf.", "al.", "ca.", "a.m.", "p.m.",
+}
+# candidate boundary: terminal punctuation (+ closing quotes/brackets) then whitespace
+_BOUNDARY_RE = re.compile(r"[.!?]+[\"')\]]*(?=\s)")
+
+
+# ---------- STEP TEXT (TRANSITIONS) ----------
+
+def step_text(plan: Dict[str, Any], topic_idx: int, sub_idx: int, micro_idx: int) -> str:
     """
-    Creates a natural speech-friendly version of lesson content.
+    Text the tutor says when the session arrives at a micro-section.
+    The transition only depends on the position: first step of the lesson,
+    first step of a topic, first step of a subtopic, or a continuation.
     """
+    topic = plan["topics"][topic_idx]
+    subtopic = topic["subtopics"][sub_idx]
+    micro = subtopic["micro_sections"][micro_idx]
+
+    if micro_idx > 0:
+        return f"Continuing...\n{micro}"
+
+    if sub_idx > 0:
+        return f"Moving on to a new subtopic: {subtopic['title']}.\n\n{micro}"
+
+    if topic_idx > 0:
+        return (
+            "Great progress so far.\n"
+            f"Now we will move into the next major topic: {topic['title']}.\n\n{micro}"
+        )
+
+    opening = f"Let's begin the lesson titled: {plan['title']}.\n"
+    opening += f"Our first topic is: {topic['title']}.\n"
+    opening += f"We'll start with the subtopic: {subtopic['title']}.\n\n"
+    return opening + micro
+
+
+# ---------- SENTENCES & SSML ----------
+
+def _ends_sentence(text: str, end: int) -> bool:
+    """True if the punctuation ending at `end` closes a sentence."""
+    last_word = text[:end].rsplit(None, 1)[-1].lower().rstrip("\"')]")
+    if last_word in _ABBREVIATIONS:
+        return False
+    # single-letter initials like "J. Smith"
+    if len(last_word) == 2 and last_word[0].isalpha() and last_word[1] == ".":
+        return False
+    return True
 
-    topic = section["topic"]
-    sub = section["subtopic"]
-    content = section["content"]
 
-    # Intro transitions
-    if micro_index == 0:
-        spoken = f"📘 New topic: {topic}. Now focusing on: {sub}. Let's begin. "
-    elif micro_index == total_micro - 1:
-        spoken = f"Alright, final part of {sub}: "
-    else:
-        spoken = "Continuing: "
+def iter_sentences(text: str) -> Iterator[str]:
+    """
+    Yield sentences one by one. Decimals ("3.14") never match because a
+    boundary needs whitespace after the punctuation; abbreviations and
+    initials are skipped. Line breaks also end a sentence.
+    """
+    for line in text.split("\n"):
+        start = 0
+        for m in _BOUNDARY_RE.finditer(line):
+            if _ends_sentence(line, m.end()):
+                sentence = line[start : m.end()].strip()
+                if sentence:
+                    yield sentence
+                start = m.end()
+        rest = line[start:].strip()
+        if rest:
+            yield rest
 
-    spoken += content
 
-    # Add pacing pauses for TTS
-    return _tts_pacing(spoken)
+def sentence_ssml(sentence: str) -> str:
+    return f"<speak>{escape(sentence)}</speak>"
 
 
 def _tts_pacing(text: str) -> str:
-    processed = text.replace(".", ". <break time='500ms'/>")
-    return f"<speak>{processed}</speak>"
+    """Whole-text SSML: pauses between sentences, longer ones between paragraphs."""
+    paragraphs = [p for p in re.split(r"\n\s*\n", text) if p.strip()]
+    rendered = []
+    for para in paragraphs:
+        sentences = [escape(s) for s in iter_sentences(para)]
+        rendered.append(f" {_SENTENCE_BREAK} ".join(sentences))
+    return f"<speak>{f' {_PARAGRAPH_BREAK} '.join(rendered)}</speak>"
+
+
+def format_script(plan: Dict[str, Any], topic_idx: int, sub_idx: int, micro_idx: int) -> str:
+    """
+    Creates a natural speech-friendly (SSML) version of a lesson step.
+    """
+    return _tts_pacing(step_text(plan, topic_idx, sub_idx, micro_idx))
+
+
+def render_step(text: str) -> Dict[str, Any]:
+    return {
+        "text": text,
+        "ssml": _tts_pacing(text),
+        "sentences": [{"text": s, "ssml": sentence_ssml(s)} for s in iter_sentences(text)],
+    }
+
+
+# ---------- PRECOMPUTED CACHE ----------
+
+def render_lesson_speech(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    {
+      "steps": [[[step, ...] per subtopic] per topic],   # step = render_step(...)
+      "end": render_step(END_OF_LESSON)
+    }
+    """
+    steps: List[List[List[Dict[str, Any]]]] = []
+    for t_idx, topic in enumerate(plan["topics"]):
+        topic_steps = []
+        for s_idx, sub in enumerate(topic["subtopics"]):
+            topic_steps.append(
+                [
+                    render_step(step_text(plan, t_idx, s_idx, m_idx))
+                    for m_idx in range(len(sub["micro_sections"]))
+                ]
+            )
+        steps.append(topic_steps)
+    return {"steps": steps, "end": render_step(END_OF_LESSON)}
+
+
+def save_lesson_speech(lesson_id: str, plan: Dict[str, Any]) -> str:
+    path = os.path.join(BASE_LESSON_DIR, lesson_id, "speech.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(render_lesson_speech(plan), f, ensure_ascii=False)
+    return path
+
+
+def load_lesson_speech(lesson_id: str) -> Optional[Dict[str, Any]]:
+    """Cached speech for a lesson, or None for lessons saved before the cache."""
+    path = os.path.join(BASE_LESSON_DIR, lesson_id, "speech.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -7,10 +7,12 @@ Since this project is now an API service, the interactive loop is removed.
 We keep only the helper logic used by the backend (e.g., formatting messages for LLM).
 """
 
-def build_qa_messages(question, topic, subtopic, micro_sections, context):
+def build_qa_messages(question, topic, subtopic, micro_sections, context, history=None):
     """
     Build a structured dialogue message to send to the language model
     for context-aware question answering.
+    `history` (from DialogueMemory.messages) goes between the system prompt
+    and the new question, so follow-ups like "explain that again" work.
     """
     return [
         {
@@ -20,6 +22,7 @@ def build_qa_messages(question, topic, subtopic, micro_sections, context):
                 "Keep responses simple, direct, and focused on the lesson context."
             )
         },
+        *(history or []),
         {
             "role": "user",
             "content": f"""
@@ -0,0 +1,278 @@
+# app/uploads.py
+
+"""
+Streaming PDF uploads.
+
+The multipart body is parsed straight off the request stream instead of
+letting the framework spool the whole form first:
+
+- each file part is written to a temporary file next to its destination
+  as the bytes arrive, hashed (sha256) on the way, and moved into place
+  with an atomic rename once complete;
+- a part over UPLOAD_MAX_MB is aborted as soon as it crosses the limit;
+- parsing and disk writes run in a worker thread, one received chunk at a
+  time, so the event loop is never blocked;
+- `on_file` is called as each file completes, so ingestion of the first
+  PDFs starts while later ones are still uploading. (A single PDF cannot
+  be parsed before its trailer/xref at the end of the file arrives.)
+
+Destination names come from slugify(title), never from raw user input;
+files in one upload whose titles share a slug are renamed "title 2", ...
+"""
+
+import hashlib
+import os
+import uuid
+from typing import Callable, Dict, List, Optional, Set
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.exceptions import MultipartParseError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.exceptions import MultipartParseError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from app.config import UPLOAD_MAX_BYTES
+from app.lesson_plan import slugify, unique_title
+
+_PDF_MAGIC = b"%PDF-"
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        # files of the same request already moved into place before the error
+        self.saved: List["SavedUpload"] = []
+
+
+class SavedUpload:
+    def __init__(self, filename: str, title: str, path: str, sha256: str, size: int):
+        self.filename = filename
+        self.title = title
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"filename": self.filename, "title": self.title, "sha256": self.sha256, "size": self.size}
+
+
+class _PartWriter:
+    """One file part: temp file + running hash, renamed into place on finish()."""
+
+    def __init__(self, filename: str, title: str, path: str, max_bytes: int):
+        self.filename = filename
+        self.title = title
+        self.path = path
+        self.max_bytes = max_bytes
+        self.tmp_path = os.path.join(
+            os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.part"
+        )
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self._head = b""
+        self._f = open(self.tmp_path, "wb")
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadError(413, f"'{self.filename}' exceeds {self.max_bytes // 2**20} MB")
+        if len(self._head) < len(_PDF_MAGIC):
+            self._head += data[: len(_PDF_MAGIC)]
+            if not _PDF_MAGIC.startswith(self._head[: len(_PDF_MAGIC)]):
+                raise UploadError(400, f"'{self.filename}' is not a PDF")
+        self.hash.update(data)
+        self._f.write(data)
+
+    def finish(self) -> SavedUpload:
+        if self.size < len(_PDF_MAGIC):
+            self.abort()
+            raise UploadError(400, f"'{self.filename}' is empty or not a PDF")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.tmp_path, self.path)
+        return SavedUpload(self.filename, self.title, self.path, self.hash.hexdigest(), self.size)
+
+    def abort(self) -> None:
+        self._f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class _PdfFormParser:
+    """
+    python-multipart callbacks -> _PartWriter per file part. Non-file
+    fields are ignored. `title_for(filename)` names each file.
+    """
+
+    def __init__(
+        self,
+        boundary: bytes,
+        dest_dir: str,
+        title_for: Callable[[str], str],
+        on_file: Optional[Callable[[SavedUpload], None]],
+        max_bytes: int,
+        max_files: Optional[int],
+    ):
+        self.dest_dir = dest_dir
+        self.max_files = max_files
+        self.title_for = title_for
+        self.on_file = on_file
+        self.max_bytes = max_bytes
+        self.saved: List[SavedUpload] = []
+        self._lesson_ids: Set[str] = set()
+        self._headers: Dict[bytes, bytes] = {}
+        self._field = b""
+        self._value = b""
+        self._writer: Optional[_PartWriter] = None
+        self._ended = False
+        self.parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_end": self._on_end,
+            },
+        )
+
+    # ---------- callbacks ----------
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+        self._writer = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._field.lower()] = self._value
+        self._field, self._value = b"", b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        raw_name = options.get(b"filename")
+        if raw_name is None:
+            return  # plain form field
+        filename = os.path.basename(raw_name.decode("utf-8", "replace").replace("\\", "/"))
+        if self.max_files is not None and len(self.saved) >= self.max_files:
+            raise UploadError(400, f"At most {self.max_files} file(s) per upload")
+        if not filename.lower().endswith(".pdf"):
+            raise UploadError(400, f"Only PDF files are allowed: {filename}")
+        title = self.title_for(filename)
+        if not slugify(title):
+            raise UploadError(400, f"Cannot derive a lesson name from '{title}'")
+        # "Ch1.pdf" and "ch1.pdf" share a slug; don't let one overwrite the other
+        title = unique_title(title, self._lesson_ids)
+        lesson_id = slugify(title)
+        self._lesson_ids.add(lesson_id)
+        path = os.path.join(self.dest_dir, f"{lesson_id}.pdf")
+        self._writer = _PartWriter(filename, title, path, self.max_bytes)
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._writer is not None:
+            self._writer.write(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        saved = writer.finish()
+        self.saved.append(saved)
+        if self.on_file is not None:
+            self.on_file(saved)
+
+    def _on_end(self) -> None:
+        self._ended = True
+
+    # ---------- driving ----------
+
+    def feed(self, chunk: bytes) -> None:
+        self.parser.write(chunk)
+
+    def close(self) -> None:
+        self.parser.finalize()
+        # finalize() does not check this itself; a truncated body would
+        # otherwise leave its last part silently unfinished
+        if not self._ended:
+            raise MultipartParseError("Body ended before the closing boundary")
+
+    def abort(self) -> None:
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+
+def multipart_boundary(request: Request) -> bytes:
+    """
+    Boundary of a multipart/form-data request; UploadError(400) for any
+    other content type. Cheap enough to check before setting anything up.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError(400, "Expected a multipart/form-data upload")
+    return boundary
+
+
+async def stream_pdf_uploads(
+    request: Request,
+    dest_dir: str,
+    title_for: Callable[[str], str],
+    on_file: Optional[Callable[[SavedUpload], None]] = None,
+    max_bytes: int = UPLOAD_MAX_BYTES,
+    max_files: Optional[int] = None,
+) -> List[SavedUpload]:
+    """
+    Save every PDF part of a multipart/form-data request into dest_dir as
+    <slugify(title)>.pdf. Raises UploadError (status + detail) on a bad or
+    oversized upload; already completed files are kept and listed in
+    `error.saved` (see remove_uploads).
+    """
+    boundary = multipart_boundary(request)
+    os.makedirs(dest_dir, exist_ok=True)
+    form = _PdfFormParser(boundary, dest_dir, title_for, on_file, max_bytes, max_files)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                # parse + write off the event loop, in arrival order
+                await run_in_threadpool(form.feed, chunk)
+        await run_in_threadpool(form.close)
+    except UploadError as e:
+        form.abort()
+        e.saved = list(form.saved)
+        raise
+    except MultipartParseError as e:
+        form.abort()
+        error = UploadError(400, f"Malformed multipart body: {e}")
+        error.saved = list(form.saved)
+        raise error from e
+    except BaseException:
+        form.abort()
+        raise
+
+    if not form.saved:
+        raise UploadError(400, "No PDF file in the upload")
+    return form.saved
+
+
+def remove_uploads(saved: List[SavedUpload]) -> None:
+    """Delete files saved by a request that is being rejected."""
+    for upload in saved:
+        try:
+            os.remove(upload.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,106 @@
+"""
+Chunking benchmark: legacy char-based chunk_text vs span-based token chunker.
+
+Usage (from backend/ai-backend):
+    python benchmarks/bench_chunking.py [--mb 20] [--embedder]
+
+--embedder counts real MiniLM tokens (needs sentence-transformers);
+without it a regex word/punctuation tokenizer stands in.
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.chunker import chunk_spans, hf_token_offsets, regex_token_offsets  # noqa: E402
+
+
+def legacy_chunk_text(text, chunk_size=800, overlap=200):
+    # verbatim copy of the previous app.rag.chunk_text, kept for comparison
+    paras = []
+    for p in re.split(r"\n\s*\n+", text):
+        p = p.strip()
+        if p:
+            paras.append(re.sub(r"[ \t]+", " ", p))
+    chunks, current = [], ""
+    for para in paras:
+        if not current:
+            current = para
+            continue
+        if len(current) + 2 + len(para) <= chunk_size:
+            current = f"{current}\n\n{para}"
+        else:
+            chunks.append(current)
+            if overlap > 0 and len(current) > overlap:
+                current = f"{current[-overlap:]}\n\n{para}"
+            else:
+                current = para
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def synthetic_text(n_bytes, seed=0):
+    rnd = random.Random(seed)
+    words = [
+        "photosynthesis", "chlorophyll", "energy", "the", "of", "cell", "ATP",
+        "reaction", "3.2", "glucose", "light", "and", "is", "in", "H2O", "CO2",
+    ]
+    out, size = [], 0
+    while size < n_bytes:
+        para = " ".join(
+            " ".join(rnd.choice(words) for _ in range(rnd.randint(6, 24))) + "."
+            for _ in range(rnd.randint(1, 12))
+        )
+        out.append(para)
+        size += len(para) + 2
+    return "\n\n".join(out)
+
+
+def measure(label, fn):
+    # time and memory in separate runs: tracemalloc slows allocation-heavy code
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    del result
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<28} {elapsed * 1000:9.1f} ms   peak {peak / 2**20:8.1f} MiB   {len(result)} chunks")
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=float, default=20.0)
+    ap.add_argument("--embedder", action="store_true")
+    args = ap.parse_args()
+
+    offsets_fn = regex_token_offsets
+    if args.embedder:
+        from sentence_transformers import SentenceTransformer
+
+        offsets_fn = hf_token_offsets(SentenceTransformer("all-MiniLM-L6-v2").tokenizer)
+
+    text = synthetic_text(int(args.mb * 2**20))
+    print(f"text: {len(text) / 2**20:.1f} MiB, tokenizer: {'MiniLM' if args.embedder else 'regex'}")
+
+    legacy = measure("legacy chunk_text (strings)", lambda: legacy_chunk_text(text))
+    spans = measure("chunk_spans (spans only)", lambda: chunk_spans(text, 200, 50, offsets_fn))
+    measure("chunk_spans + slicing", lambda: [text[s:e] for s, e in chunk_spans(text, 200, 50, offsets_fn)])
+
+    over = sum(1 for c in legacy if len(offsets_fn([c])[0]) > 254)
+    print(f"legacy chunks over a 254-token window: {over}/{len(legacy)}")
+    print(f"span chunks over a 254-token window:   "
+          f"{sum(1 for s, e in spans if len(offsets_fn([text[s:e]])[0]) > 254)}/{len(spans)}")
+
+
+if __name__ == "__main__":
+    main()
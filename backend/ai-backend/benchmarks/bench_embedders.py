@@ -0,0 +1,132 @@
+"""
+Embedder backends compared on CPU: torch vs ONNX Runtime vs int8 ONNX.
+
+Usage (from backend/ai-backend):
+    python benchmarks/bench_embedders.py [--lesson <lesson_id>] [--threads 4] [--batch 32] [--k 4]
+
+Corpus: the chunks of one saved lesson (or every lesson under
+BASE_LESSON_DIR), else a synthetic corpus. Queries: the lesson plans'
+subtopic and micro-section titles, else the first sentence of sampled
+chunks. For every backend it reports:
+
+- bulk encode throughput (chunks/s), the build_rag_index pattern
+- single-query latency p50/p95 (ms), the rag_search pattern
+- retrieval agreement with torch: mean overlap of top-k chunk ids
+  (recall@k of the torch result) and top-1 match rate
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import faiss  # noqa: E402
+import numpy as np  # noqa: E402
+
+from app.config import BASE_LESSON_DIR  # noqa: E402
+from app.embedders import BACKENDS, load_embedder  # noqa: E402
+
+
+def _load_corpus(lesson_id):
+    pattern = os.path.join(BASE_LESSON_DIR, lesson_id or "*", "chunks.json")
+    chunks, queries = [], []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r", encoding="utf-8") as f:
+            chunks.extend(json.load(f))
+        plan_path = os.path.join(os.path.dirname(path), "plan.json")
+        if os.path.exists(plan_path):
+            with open(plan_path, "r", encoding="utf-8") as f:
+                plan = json.load(f)
+            for topic in plan.get("topics", []):
+                for sub in topic.get("subtopics", []):
+                    queries.append(sub.get("title", ""))
+                    queries.extend(m for m in sub.get("micro_sections", []) if isinstance(m, str))
+    if not chunks:
+        base = "Photosynthesis converts light energy into chemical energy stored in glucose. "
+        chunks = [f"Section {i}. " + base * (3 + i % 5) for i in range(2000)]
+    queries = [q for q in queries if q.strip()]
+    if not queries:
+        rng = random.Random(0)
+        queries = [c.split(". ")[0] for c in rng.sample(chunks, min(200, len(chunks)))]
+    return chunks, queries[:300]
+
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def bench(backend, chunks, queries, threads, batch, k):
+    embedder = load_embedder(backend, threads=threads, batch_size=batch)
+    embedder.encode(["warm up"] * 8)
+
+    t0 = time.perf_counter()
+    doc_vecs = _normalized(embedder.encode(chunks))
+    encode_s = time.perf_counter() - t0
+
+    latencies, q_vecs = [], []
+    for q in queries:
+        t = time.perf_counter()
+        q_vecs.append(embedder.encode([q])[0])
+        latencies.append((time.perf_counter() - t) * 1000)
+    q_vecs = _normalized(np.vstack(q_vecs))
+
+    index = faiss.IndexFlatIP(doc_vecs.shape[1])
+    index.add(doc_vecs)
+    _, ids = index.search(q_vecs, k)
+
+    latencies.sort()
+    return {
+        "chunks_per_s": len(chunks) / encode_s,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+        "ids": ids,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lesson", default=None)
+    ap.add_argument("--backends", nargs="+", default=list(BACKENDS))
+    ap.add_argument("--threads", type=int, default=0)
+    ap.add_argument("--batch", type=int, default=32)
+    ap.add_argument("--k", type=int, default=4)
+    args = ap.parse_args()
+
+    chunks, queries = _load_corpus(args.lesson)
+    print(f"corpus: {len(chunks)} chunks, {len(queries)} queries, k={args.k}, threads={args.threads or 'default'}")
+
+    backends = ["torch"] + [b for b in args.backends if b != "torch"]
+    results = {}
+    for backend in backends:
+        try:
+            results[backend] = bench(backend, chunks, queries, args.threads, args.batch, args.k)
+        except Exception as e:
+            print(f"{backend:<10} unavailable: {e}")
+
+    base = results.get("torch")
+    print(f"{'backend':<10} {'chunks/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'recall@k':>9} {'top1':>6}")
+    for backend, r in results.items():
+        recall = top1 = float("nan")
+        if base is not None:
+            overlaps = [
+                len(set(a) & set(b)) / len(b) for a, b in zip(r["ids"].tolist(), base["ids"].tolist())
+            ]
+            recall = sum(overlaps) / len(overlaps)
+            top1 = float(np.mean(r["ids"][:, 0] == base["ids"][:, 0]))
+        print(
+            f"{backend:<10} {r['chunks_per_s']:>10.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+            f"{recall:>9.3f} {top1:>6.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
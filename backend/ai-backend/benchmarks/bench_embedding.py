@@ -0,0 +1,98 @@
+"""
+Embedding memory/throughput: in-process SentenceTransformer per worker vs
+the shared embedding service (app.embed_service).
+
+Usage (from backend/ai-backend, Linux/macOS):
+    python benchmarks/bench_embedding.py [--workers 1 4 8] [--queries 200]
+
+Each simulated API worker is a separate process that encodes `--queries`
+single-sentence queries (the rag_search pattern) followed by one bulk
+batch of chunk-sized texts (the build_rag_index pattern). Reported memory
+is the sum of peak RSS over all workers (+ the service process).
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import secrets
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+QUERY = "What is the role of chlorophyll in photosynthesis?"
+CHUNK = " ".join(["Photosynthesis converts light energy into chemical energy."] * 12)
+
+
+def _peak_rss_mb(pid=None):
+    if pid is None:
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / 1024 if sys.platform != "darwin" else kb / 2**20
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _worker(mode, n_queries, n_bulk, start, out):
+    if mode == "service":
+        os.environ["EMBED_SERVICE"] = "1"
+    from app.rag import get_embedder
+
+    embedder = get_embedder()
+    embedder.encode(["warm up"])
+    start.wait()
+    t0 = time.perf_counter()
+    for _ in range(n_queries):
+        embedder.encode([QUERY], show_progress_bar=False)
+    embedder.encode([CHUNK] * n_bulk, show_progress_bar=False)
+    out.put((time.perf_counter() - t0, n_queries + n_bulk, _peak_rss_mb()))
+
+
+def run(mode, workers, n_queries, n_bulk):
+    ctx = mp.get_context("spawn")
+    start, out = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(mode, n_queries, n_bulk, start, out)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    time.sleep(1.0)
+    t0 = time.perf_counter()
+    start.set()
+    results = [out.get() for _ in procs]
+    wall = time.perf_counter() - t0
+    for p in procs:
+        p.join()
+    texts = sum(r[1] for r in results)
+    return texts / wall, sum(r[2] for r in results)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--bulk", type=int, default=256)
+    args = ap.parse_args()
+    # spawned workers and the service inherit it
+    os.environ.setdefault("EMBED_SERVICE_AUTHKEY", secrets.token_hex(32))
+
+    print(f"{'mode':<10}{'workers':>8}{'texts/s':>12}{'RSS MiB':>12}")
+    for workers in args.workers:
+        tput, rss = run("inproc", workers, args.queries, args.bulk)
+        print(f"{'inproc':<10}{workers:>8}{tput:>12.1f}{rss:>12.0f}")
+
+    service = subprocess.Popen([sys.executable, "-m", "app.embed_service"], cwd=ROOT)
+    try:
+        for workers in args.workers:
+            tput, rss = run("service", workers, args.queries, args.bulk)
+            rss += _peak_rss_mb(service.pid)
+            print(f"{'service':<10}{workers:>8}{tput:>12.1f}{rss:>12.0f}")
+    finally:
+        service.terminate()
+
+
+if __name__ == "__main__":
+    main()
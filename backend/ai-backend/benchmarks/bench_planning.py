@@ -0,0 +1,47 @@
+"""
+Lesson planning cost with and without batched micro-sections.
+
+Usage (from backend/ai-backend, with Ollama running):
+    python benchmarks/bench_planning.py <file.pdf> [<file.pdf> ...]
+
+Each PDF is planned twice on the same in-memory index, with
+PLANNING_BATCH off and on, and the LLM calls / generation seconds of the
+plan are reported (last_call_stats; queue wait excluded). Nothing is saved.
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app.lesson_plan as lesson_plan  # noqa: E402
+from app.utils.pdf_reader import extract_text_from_pdf  # noqa: E402
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+
+    print(f"{'file':<32}{'batch':>6}{'subtopics':>10}{'calls':>7}{'llm s':>9}{'wall s':>9}")
+    for path in sys.argv[1:]:
+        text = extract_text_from_pdf(path)
+        planning = lesson_plan.build_planning_index(text)
+        for batch in (False, True):
+            lesson_plan.PLANNING_BATCH = batch
+            t0 = time.perf_counter()
+            plan = lesson_plan.generate_lesson_plan_from_text(
+                os.path.basename(path), text, planning=planning
+            )
+            wall = time.perf_counter() - t0
+            stats = lesson_plan.last_call_stats()
+            subtopics = sum(len(t["subtopics"]) for t in plan["topics"])
+            print(
+                f"{os.path.basename(path)[:31]:<32}{int(batch):>6}{subtopics:>10}"
+                f"{stats['llm_calls']:>7}{stats['llm_seconds']:>9.1f}{wall:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
+import os
+import secrets
 import subprocess
+import sys
 import time
 import threading
 
@@ -39,6 +42,14 @@ def start_ollama():
     t.start()
 
 
+def start_embed_service():
+    print("🧮 Starting shared embedding service (EMBED_SERVICE=1)...")
+    if not os.getenv("EMBED_SERVICE_AUTHKEY"):
+        # per-launch secret, inherited by the service and the API workers
+        os.environ["EMBED_SERVICE_AUTHKEY"] = secrets.token_hex(32)
+    subprocess.Popen([sys.executable, "-m", "app.embed_service"])
+
+
 def ensure_model():
     print(f"📦 Ensuring model '{MODEL_NAME}' is available...")
     try:
@@ -68,5 +79,8 @@ if __name__ == "__main__":
 
     ensure_model()
 
+    if os.getenv("EMBED_SERVICE", "0") == "1":
+        start_embed_service()
+
     print("🔥 Starting AI Tutor FastAPI server on http://localhost:8000")
     uvicorn.run("app.api:app", host="0.0.0.0", port=8000, reload=True)